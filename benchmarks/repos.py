@@ -0,0 +1,118 @@
+"""
+Synthetic repositories for benchmarking, generated with git fast-import.
+"""
+import random
+import subprocess
+import sys
+
+
+class Stream(object):
+    """
+    Builder of a git fast-import stream.
+    """
+
+    def __init__(self):
+        self._parts = []
+        self._mark = 0
+        self._time = 1700000000
+
+    def _next_mark(self):
+        self._mark += 1
+        return self._mark
+
+    def _ident(self):
+        self._time += 60
+        return b"Bench <bench@example.com> %d +0000" % self._time
+
+    def blob(self, data):
+        mark = self._next_mark()
+        self._parts.append(b"blob\nmark :%d\ndata %d\n%s\n" % (mark, len(data), data))
+        return mark
+
+    def commit(self, ref, files, message=b"commit"):
+        """Commit files ({path: blob mark}) on top of ref."""
+        mark = self._next_mark()
+        self._parts.append(b"commit %s\nmark :%d\ncommitter %s\ndata %d\n%s\n" %
+                           (ref.encode(), mark, self._ident(), len(message), message))
+        for path, blob in files.items():
+            self._parts.append(b"M 100644 :%d %s\n" % (blob, path.encode()))
+        self._parts.append(b"\n")
+        return mark
+
+    def tag(self, name, commit, annotated):
+        if annotated:
+            message = b"release " + name.encode()
+            self._parts.append(b"tag %s\nfrom :%d\ntagger %s\ndata %d\n%s\n" %
+                               (name.encode(), commit, self._ident(), len(message), message))
+        else:
+            self._parts.append(b"reset refs/tags/%s\nfrom :%d\n\n" % (name.encode(), commit))
+
+    def data(self):
+        return b"".join(self._parts)
+
+
+def linear(size, rnd):
+    """Deep linear history: size commits, each changing one small file."""
+    s = Stream()
+    contents = {}
+    for i in range(size):
+        path = "dir%d/sub%d/file%d.txt" % (i % 7, i % 3, i % 11)
+        contents[path] = contents.get(path, b"") + b"line %d %d\n" % (i, rnd.randrange(1 << 30))
+        s.commit("refs/heads/master", {path: s.blob(contents[path])}, b"commit %d" % i)
+    return s.data()
+
+
+def wide(size, rnd):
+    """A single commit with a wide tree of size small files."""
+    s = Stream()
+    files = {}
+    for i in range(size):
+        path = "d%d/e%d/f%d.txt" % (i % 97, i % 13, i)
+        files[path] = s.blob(b"%d %x\n" % (i, rnd.getrandbits(256)) * 8)
+    s.commit("refs/heads/master", files, b"wide")
+    return s.data()
+
+
+def binaries(size, rnd):
+    """size incompressible 1 MiB binaries spread over a few commits."""
+    s = Stream()
+    for i in range(size):
+        blob = s.blob(rnd.getrandbits(8 << 20).to_bytes(1 << 20, "big"))
+        s.commit("refs/heads/master", {"bin/file%d.bin" % i: blob}, b"binary %d" % i)
+    return s.data()
+
+
+def tags(size, rnd):
+    """A short history with size tags, half of them annotated."""
+    s = Stream()
+    commits = []
+    for i in range(50):
+        blob = s.blob(b"version %d %d\n" % (i, rnd.randrange(1 << 30)))
+        commits.append(s.commit("refs/heads/master", {"VERSION": blob}, b"bump %d" % i))
+    for i in range(size):
+        s.tag("v0.%d" % i, commits[i % len(commits)], annotated=i % 2 == 0)
+    return s.data()
+
+
+SCENARIOS = {
+    "linear": linear,
+    "wide": wide,
+    "binaries": binaries,
+    "tags": tags,
+}
+
+
+def generate(path, scenario, size, seed=0):
+    """Create a git repository at path, filled according to scenario."""
+    subprocess.check_call(["git", "init", "-q", path])
+    stream = SCENARIOS[scenario](size, random.Random(seed))
+    p = subprocess.Popen(["git", "fast-import", "--quiet"], cwd=path, stdin=subprocess.PIPE)
+    p.communicate(stream)
+    if p.returncode != 0:
+        raise Exception("git fast-import failed")
+    subprocess.check_call(["git", "symbolic-ref", "HEAD", "refs/heads/master"], cwd=path)
+
+
+if __name__ == "__main__":
+    # Usage: python -m benchmarks.repos <path> <scenario> <size> [<seed>]
+    generate(sys.argv[1], sys.argv[2], int(sys.argv[3]), int(sys.argv[4]) if len(sys.argv) > 4 else 0)
@@ -0,0 +1,210 @@
+"""
+Benchmark git push and clone through git-remote-blossom against local
+blossom and relay stand-ins.
+
+    python -m benchmarks.run --scenario linear --size 1000 --latency 0.01 -o result.json
+
+Every phase reports its wall time, objects/s, bytes/s, the requests seen by
+the servers, the number of git processes spawned and the peak RSS of the
+git process tree (including git-remote-blossom), as JSON. The startup phase is
+the cold start of the helper: the time until it answered "capabilities".
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from benchmarks.repos import SCENARIOS
+
+
+# npub of the test key nostr.sec=1, see README.
+NPUB = "npub10xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqpkge6d"
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def server_stats(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stats") as resp:
+        return json.load(resp)
+
+
+def start_servers(port, args):
+    cmd = [sys.executable, "-m", "benchmarks.servers", "--port", str(port),
+           "--latency", str(args.latency), "--bandwidth", str(args.bandwidth),
+           "--error-rate", str(args.error_rate)]
+    p = subprocess.Popen(cmd, cwd=ROOT)
+    for _ in range(100):
+        try:
+            server_stats(port)
+            return p
+        except OSError:
+            time.sleep(0.1)
+    p.kill()
+    raise Exception("benchmark servers did not start")
+
+
+def git_env(home, port, configs):
+    env = dict(os.environ)
+    env["HOME"] = home
+    env["GIT_CONFIG_NOSYSTEM"] = "1"
+    env.pop("GIT_DIR", None)
+    settings = [
+        ("user.name", "Bench"),
+        ("user.email", "bench@example.com"),
+        ("nostr.relay", f"ws://127.0.0.1:{port}"),
+        ("nostr.blossom", f"http://127.0.0.1:{port}"),
+        ("nostr.sec", "1"),
+    ] + configs
+    for key, value in settings:
+        subprocess.check_call(["git", "config", "--global", "--add", key, value], env=env)
+    return env
+
+
+def count_processes(trace_file):
+    """Return the number of git processes recorded in a trace2 event file."""
+    if not os.path.exists(trace_file):
+        return 0
+    count = 0
+    with open(trace_file) as f:
+        for line in f:
+            if '"event":"start"' in line:
+                count += 1
+    return count
+
+
+def run_phase(name, cmd, cwd, env, port, objects=None, stdin=b""):
+    trace_file = os.path.join(env["HOME"], f"trace2-{name}.json")
+    env = dict(env, GIT_TRACE2_EVENT=trace_file)
+    before = server_stats(port)
+
+    with tempfile.TemporaryFile() as err, tempfile.TemporaryFile() as inp:
+        inp.write(stdin)
+        inp.seek(0)
+        start = time.monotonic()
+        p = subprocess.Popen(cmd, cwd=cwd, env=env, stdin=inp, stdout=subprocess.DEVNULL, stderr=err)
+        # wait4 reports the peak RSS of the child and its waited-for descendants.
+        _, status, rusage = os.wait4(p.pid, 0)
+        p.returncode = os.waitstatus_to_exitcode(status)
+        seconds = time.monotonic() - start
+        err.seek(0)
+        stderr = err.read().decode("utf8", "replace")
+
+    after = server_stats(port)
+    delta = {k: after.get(k, 0) - before.get(k, 0) for k in after}
+    bytes_up = delta.pop("bytes_in", 0)
+    bytes_down = delta.pop("bytes_out", 0)
+    result = {
+        "command": " ".join(cmd),
+        "exit_code": p.returncode,
+        "seconds": round(seconds, 4),
+        "bytes_up": bytes_up,
+        "bytes_down": bytes_down,
+        "bytes_per_s": round((bytes_up + bytes_down) / seconds) if seconds else 0,
+        "requests": {k: v for k, v in delta.items() if v},
+        "git_processes": count_processes(trace_file),
+        "peak_rss_kb": rusage.ru_maxrss,
+    }
+    if objects is not None:
+        result["objects"] = objects
+        result["objects_per_s"] = round(objects / seconds, 1) if seconds else 0
+    if p.returncode != 0:
+        result["stderr"] = stderr[-2000:]
+    return result
+
+
+def run_startup(src, url, env, port, runs=5):
+    """Run the helper on "capabilities" only, and return the median run."""
+    env = dict(env, GIT_DIR=os.path.join(src, ".git"))
+    results = [run_phase("startup", ["git-remote-blossom", "origin", url], src, env, port,
+                         stdin=b"capabilities\n\n")
+               for _ in range(runs)]
+    results.sort(key=lambda r: r["seconds"])
+    result = results[runs // 2]
+    result["runs"] = [r["seconds"] for r in results]
+    return result
+
+
+def run_scenario(scenario, args, port):
+    work = tempfile.mkdtemp(prefix=f"bench-{scenario}-")
+    try:
+        home = os.path.join(work, "home")
+        os.makedirs(home)
+        env = git_env(home, port, [tuple(c.split("=", 1)) for c in args.config])
+        src = os.path.join(work, "src")
+        # Generate in a separate process: a forked child starts with the peak
+        # RSS of its parent, so this process has to stay small.
+        subprocess.check_call([sys.executable, "-m", "benchmarks.repos", src, scenario,
+                               str(args.size), str(args.seed)], cwd=ROOT, env=env)
+        objects = len(subprocess.check_output(
+            ["git", "rev-list", "--all", "--objects"], cwd=src, env=env).splitlines())
+
+        url = f"blossom://{NPUB}/bench-{scenario}-{random.randrange(1 << 32):08x}"
+        subprocess.check_call(["git", "remote", "add", "origin", url], cwd=src, env=env)
+
+        phases = {}
+        phases["startup"] = run_startup(src, url, env, port)
+        phases["push"] = run_phase(
+            "push", ["git", "push", "-q", "origin", "refs/heads/*:refs/heads/*", "refs/tags/*:refs/tags/*"],
+            src, env, port, objects)
+        phases["ls-remote"] = run_phase("ls-remote", ["git", "ls-remote", "origin"], src, env, port)
+        phases["clone"] = run_phase(
+            "clone", ["git", "clone", "-q", "--bare", url, os.path.join(work, "dst")],
+            work, env, port, objects)
+        phases["fetch-noop"] = run_phase(
+            "fetch-noop", ["git", "fetch", "-q", "origin"], os.path.join(work, "dst"), env, port)
+
+        return {"objects": objects, "phases": phases}
+    finally:
+        if not args.keep:
+            shutil.rmtree(work, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS) + ["all"], default="all")
+    parser.add_argument("--size", type=int, default=200, help="scenario size (commits, files, MiB or tags)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every server request")
+    parser.add_argument("--bandwidth", type=int, default=0, help="bytes/s per download, 0 is unlimited")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of blob requests failing")
+    parser.add_argument("--config", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra git config for the helper, can be repeated")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary repositories")
+    parser.add_argument("-o", "--output", help="write JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    scenarios = sorted(SCENARIOS) if args.scenario == "all" else [args.scenario]
+    port = free_port()
+    servers = start_servers(port, args)
+    try:
+        report = {
+            "params": {k: v for k, v in vars(args).items() if k not in ("output", "keep")},
+            "git": subprocess.check_output(["git", "--version"]).decode().strip(),
+            "scenarios": {s: run_scenario(s, args, port) for s in scenarios},
+        }
+    finally:
+        servers.terminate()
+        servers.wait()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
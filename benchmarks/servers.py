@@ -0,0 +1,149 @@
+"""
+Local stand-ins for a blossom server and a nostr relay, for benchmarking.
+
+Both are served by one aiohttp app: the relay on the websocket at "/", blobs
+on "/upload" and "/<sha256>". Latency, bandwidth and errors can be injected.
+
+    python -m benchmarks.servers --port 7777 --latency 0.02 --bandwidth 10000000
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+
+from aiohttp import web, WSMsgType
+
+
+class Stats(object):
+    def __init__(self):
+        self.counters = {}
+
+    def inc(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+
+class Servers(object):
+    def __init__(self, latency=0.0, bandwidth=0, error_rate=0.0):
+        self._latency = latency
+        self._bandwidth = bandwidth  # bytes/s per response, 0 is unlimited
+        self._error_rate = error_rate
+        self._blobs = {}
+        self._events = {}
+        self.stats = Stats()
+
+    def app(self):
+        app = web.Application(client_max_size=1 << 31)
+        app.router.add_get("/", self.relay)
+        app.router.add_get("/_stats", self.get_stats)
+        app.router.add_put("/upload", self.upload)
+        app.router.add_route("GET", "/{key}", self.download)
+        app.router.add_route("HEAD", "/{key}", self.download)
+        return app
+
+    async def _delay(self):
+        if self._latency:
+            await asyncio.sleep(self._latency)
+
+    def _inject_error(self):
+        if self._error_rate and random.random() < self._error_rate:
+            self.stats.inc("errors_injected")
+            return web.Response(status=503, text="injected error")
+        return None
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats.counters)
+
+    async def upload(self, request):
+        self.stats.inc("put")
+        await self._delay()
+        data = await request.read()
+        self.stats.inc("bytes_in", len(data))
+        error = self._inject_error()
+        if error is not None:
+            return error
+        key = hashlib.sha256(data).hexdigest()
+        self._blobs[key] = data
+        return web.json_response({"sha256": key, "size": len(data)})
+
+    async def download(self, request):
+        head = request.method == "HEAD"
+        self.stats.inc("head" if head else "get")
+        await self._delay()
+        error = self._inject_error()
+        if error is not None:
+            return error
+        data = self._blobs.get(request.match_info["key"])
+        if data is None:
+            return web.Response(status=404, text="not found")
+        if head:
+            return web.Response(headers={"Content-Length": str(len(data))})
+
+        self.stats.inc("bytes_out", len(data))
+        if not self._bandwidth:
+            return web.Response(body=data)
+
+        resp = web.StreamResponse(headers={"Content-Length": str(len(data))})
+        await resp.prepare(request)
+        chunk = max(1024, self._bandwidth // 100)
+        for off in range(0, len(data), chunk):
+            await resp.write(data[off:off + chunk])
+            await asyncio.sleep(len(data[off:off + chunk]) / self._bandwidth)
+        await resp.write_eof()
+        return resp
+
+    def _match(self, ev, f):
+        if "kinds" in f and ev["kind"] not in f["kinds"]:
+            return False
+        if "authors" in f and ev["pubkey"] not in f["authors"]:
+            return False
+        if "ids" in f and ev["id"] not in f["ids"]:
+            return False
+        for name, values in f.items():
+            if name.startswith("#"):
+                tags = [t[1] for t in ev["tags"] if len(t) > 1 and t[0] == name[1:]]
+                if not set(tags) & set(values):
+                    return False
+        return True
+
+    async def relay(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                continue
+            await self._delay()
+            m = json.loads(msg.data)
+            if m[0] == "REQ":
+                self.stats.inc("relay_req")
+                for ev in list(self._events.values()):
+                    if any(self._match(ev, f) for f in m[2:]):
+                        await ws.send_str(json.dumps(["EVENT", m[1], ev]))
+                await ws.send_str(json.dumps(["EOSE", m[1]]))
+            elif m[0] == "EVENT":
+                self.stats.inc("relay_event")
+                ev = m[1]
+                self.stats.inc("relay_bytes_in", len(msg.data))
+                d = [t[1] for t in ev["tags"] if len(t) > 1 and t[0] == "d"]
+                key = (ev["kind"], ev["pubkey"], d[0] if d else "")
+                old = self._events.get(key)
+                if old is None or old["created_at"] <= ev["created_at"]:
+                    self._events[key] = ev
+                await ws.send_str(json.dumps(["OK", ev["id"], True, ""]))
+        return ws
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--port", type=int, default=7777)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--bandwidth", type=int, default=0, help="bytes/s per download, 0 is unlimited")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of blob requests failing with 503")
+    args = parser.parse_args()
+
+    servers = Servers(args.latency, args.bandwidth, args.error_rate)
+    web.run_app(servers.app(), host="127.0.0.1", port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+import os
+import time
+import hashlib
+import tempfile
+import random
+import asyncio
+from collections import deque
+
+from git_remote_blossom.constants import EWMA_ALPHA, HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES, MAX_RETRIES, \
+    HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, STALL_WINDOW, STALL_MIN_RATE, RETRY_BACKOFF
+from git_remote_blossom.metrics import metrics
+from git_remote_blossom.util import Level
+
+
+class BlossomError(Exception):
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def _status_error(url, status, text):
+    """Return the error for an HTTP error response. Server side trouble is worth a retry."""
+    return BlossomError(f"{url}: {status} {text}", retryable=status >= 500 or status in (408, 429))
+
+
+def is_retryable(e):
+    """Return whether a request failing with e may succeed when repeated."""
+    if isinstance(e, BlossomError):
+        return e.retryable
+    if isinstance(e, asyncio.TimeoutError):
+        return True
+    import aiohttp
+    return isinstance(e, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError))
+
+
+class BlossomServer(object):
+    """
+    A blossom server together with its measured performance.
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.latency = None  # EWMA of seconds until response headers
+        self.throughput = None  # EWMA of body bytes/s
+        self.failures = 0
+
+    def record(self, latency, size, duration):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += EWMA_ALPHA * (latency - self.latency)
+
+        if duration > 0 and size > 0:
+            rate = size / duration
+            if self.throughput is None:
+                self.throughput = rate
+            else:
+                self.throughput += EWMA_ALPHA * (rate - self.throughput)
+
+    def expected_time(self, size):
+        """
+        Return the expected seconds to download size bytes from this server.
+        Unmeasured servers are tried first so that every server gets measured.
+        """
+        if self.latency is None:
+            return 0.0
+        t = self.latency
+        if self.throughput:
+            t += size / self.throughput
+        return t * (1 + self.failures)
+
+    def __repr__(self):
+        return self.url
+
+
+class BlossomPool(object):
+    """
+    A set of blossom servers that mirror each other.
+
+    Uploads go to every server and succeed once write_quorum of them stored
+    the blob. Downloads go to the server expected to be fastest, and a hedged
+    request is sent to the next best server if the first one is slower than
+    the hedge_percentile of recently observed download times. Downloads are
+    checked against their key, the sha256 of the blob, and a server sending
+    other content counts as failed.
+
+    Every request has connect and read deadlines, and transfers slower than
+    STALL_MIN_RATE are aborted. Both requests are idempotent (blobs are
+    content-addressed), so retryable failures are retried up to MAX_RETRIES
+    times with jittered exponential backoff.
+    """
+
+    def __init__(self, urls, trace, write_quorum=None, hedge_percentile=HEDGE_PERCENTILE):
+        self._servers = [BlossomServer(url) for url in urls]
+        self._trace = trace
+        if write_quorum is None:
+            write_quorum = len(self._servers)
+        self._write_quorum = max(1, min(write_quorum, len(self._servers)))
+        self._hedge_percentile = hedge_percentile
+        self._durations = deque(maxlen=256)  # Recent download durations, for hedging.
+        self._avg_size = 0
+        self._session = None
+        self._closed = False
+        self._mirroring = set()  # Uploads still running after quorum was reached.
+        self.hedged = 0
+        self.retries = 0
+        self.stalls = 0
+
+    @property
+    def servers(self):
+        return self._servers
+
+    def _get_session(self):
+        if not self._servers:
+            raise BlossomError(
+                "Blossom server must be set via 'git config --global --add nostr.blossom https://your.blossom.org'")
+        if self._closed:
+            raise BlossomError("blossom pool is closed")
+        if self._session is None:
+            # Imported on first use, so that helper startup does not pay for it.
+            import aiohttp
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(
+                total=None, sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT))
+        return self._session
+
+    async def close(self):
+        """Wait for background mirror uploads, then close the HTTP session."""
+        self._closed = True
+        if self._mirroring:
+            await asyncio.wait(self._mirroring)
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _retrying(self, request, what):
+        """Return the result of await request(), retrying it on retryable errors."""
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                return await request()
+            except Exception as e:
+                if attempt == MAX_RETRIES or not is_retryable(e) or self._closed:
+                    raise
+                self.retries += 1
+                metrics.count("http_retries")
+                delay = random.uniform(0, RETRY_BACKOFF * 2 ** attempt)
+                self._trace(f"{what} failed: {e!r}, retry in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    def _check_stall(self, url, size, seconds):
+        if seconds >= STALL_WINDOW and size < STALL_MIN_RATE * seconds:
+            self.stalls += 1
+            metrics.count("http_stalls")
+            raise BlossomError(f"{url}: stalled at {size / seconds:.0f} bytes/s", retryable=True)
+
+    async def _upload_one(self, server, data, headers):
+        await self._retrying(lambda: self.__upload_one(server, data, headers), f"PUT {server.url}")
+
+    async def __upload_one(self, server, data, headers):
+        import aiohttp
+        sess = self._get_session()
+        if isinstance(data, str):
+            # Streamed from the file, opened again by every attempt.
+            size = os.path.getsize(data)
+            body = open(data, "rb")
+        else:
+            size = len(data)
+            body = data
+        metrics.count("http_bytes_out", size)
+        # The body has to go out at STALL_MIN_RATE at least.
+        timeout = aiohttp.ClientTimeout(total=HTTP_READ_TIMEOUT + size / STALL_MIN_RATE,
+                                        sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT)
+        try:
+            with metrics.span("http PUT", "http", server.url):
+                async with sess.put(f"{server.url}/upload", data=body, headers=headers, timeout=timeout) as resp:
+                    if resp.status != 200:
+                        txt = await resp.text()
+                        raise _status_error(server.url, resp.status, txt)
+
+                    await resp.text()
+        finally:
+            if body is not data:
+                body.close()
+
+    async def upload(self, data, headers):
+        """
+        Store data, the blob or the name of a file holding it, on all servers
+        and return once write_quorum of them has it.
+        """
+        self._get_session()
+        tasks = [asyncio.create_task(self._upload_one(s, data, headers)) for s in self._servers]
+        stored = 0
+        errors = []
+        pending = set(tasks)
+        try:
+            while pending and stored < self._write_quorum:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    if t.exception():
+                        errors.append(t.exception())
+                    else:
+                        stored += 1
+
+            if stored < self._write_quorum:
+                raise BlossomError(f"stored on {stored} of {self._write_quorum} required servers: " +
+                                   ", ".join(str(e) for e in errors))
+
+            # Let the remaining mirrors finish in the background.
+            for t in pending:
+                self._mirroring.add(t)
+                t.add_done_callback(self._mirror_done)
+        finally:
+            # Also when cancelled, e.g. because another upload of the push failed.
+            for t in tasks:
+                if not t.done() and t not in self._mirroring:
+                    t.cancel()
+
+    def _mirror_done(self, task):
+        self._mirroring.discard(task)
+        if not task.cancelled() and task.exception():
+            self._trace(f"mirror upload failed: {task.exception()}", Level.INFO)
+
+    def _ranked(self):
+        return sorted(self._servers, key=lambda s: s.expected_time(self._avg_size))
+
+    def _hedge_delay(self):
+        """Return seconds to wait before sending a hedged request, or None."""
+        if len(self._servers) < 2 or len(self._durations) < HEDGE_MIN_SAMPLES:
+            return None
+        durations = sorted(self._durations)
+        idx = min(len(durations) - 1, len(durations) * self._hedge_percentile // 100)
+        return durations[idx]
+
+    async def _has_one(self, server, key):
+        sess = self._get_session()
+        with metrics.span("http HEAD", "http", server.url):
+            async with sess.head(f"{server.url}/{key}") as resp:
+                if resp.status == 404:
+                    return False
+                if resp.status != 200:
+                    raise _status_error(f"{server.url}/{key}", resp.status, resp.reason)
+                return True
+
+    async def is_stored(self, key):
+        """Return whether the blob under the hex key is on write_quorum servers, without downloading it."""
+        found = await asyncio.gather(
+            *(self._retrying(lambda server=server: self._has_one(server, key), f"HEAD {server.url}/{key}")
+              for server in self._servers),
+            return_exceptions=True)
+        return sum(1 for f in found if f is True) >= self._write_quorum
+
+    async def _read_body(self, resp, url, key, out=None):
+        """
+        Read a response body into memory, or into the file out, failing if it
+        arrives slower than STALL_MIN_RATE or does not match key, its sha256.
+
+        Return the body, or None with out, and its size.
+        """
+        chunks = []
+        digest = hashlib.sha256()
+        size = 0
+        window_start = time.monotonic()
+        window_size = 0
+        async for chunk in resp.content.iter_chunked(1 << 16):
+            digest.update(chunk)
+            if out is None:
+                chunks.append(chunk)
+            else:
+                out.write(chunk)
+            size += len(chunk)
+            window_size += len(chunk)
+            now = time.monotonic()
+            if now - window_start >= STALL_WINDOW:
+                self._check_stall(url, window_size, now - window_start)
+                window_start, window_size = now, 0
+        if digest.hexdigest() != key:
+            # Blobs are stored under their sha256, another server may have it right.
+            raise BlossomError(f"{url}: content does not match the key")
+        return (b"".join(chunks) if out is None else None), size
+
+    async def _download_one(self, server, key, path=None):
+        return await self._retrying(lambda: self.__download_one(server, key, path), f"GET {server.url}/{key}")
+
+    async def __download_one(self, server, key, path):
+        sess = self._get_session()
+        start = time.monotonic()
+        # Each request has its own file, hedged requests run side by side.
+        out = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".",
+                                          delete=False) if path else None
+        try:
+            with metrics.span("http GET", "http", server.url):
+                async with sess.get(f"{server.url}/{key}") as resp:
+                    latency = time.monotonic() - start
+                    if resp.status != 200:
+                        txt = await resp.text()
+                        raise _status_error(f"{server.url}/{key}", resp.status, txt)
+                    data, size = await self._read_body(resp, f"{server.url}/{key}", key, out)
+        except BaseException as e:
+            if out is not None:
+                out.close()
+                os.unlink(out.name)
+            if isinstance(e, Exception):
+                server.failures += 1
+            raise
+        if out is not None:
+            out.close()
+            data = out.name
+
+        duration = time.monotonic() - start
+        metrics.count("http_bytes_in", size)
+        server.record(latency, size, duration - latency)
+        server.failures = 0
+        self._durations.append(duration)
+        self._avg_size += EWMA_ALPHA * (size - self._avg_size)
+        return data
+
+    async def download(self, key, path=None):
+        """
+        Return the blob stored under the hex key, trying servers in order of
+        expected speed and hedging slow requests. With path, the blob is
+        written to that file instead, and its size is returned.
+        """
+        self._get_session()
+        candidates = self._ranked()
+        running = set()
+        errors = []
+
+        def start_next():
+            server = candidates.pop(0)
+            self._trace(f"GET {server.url}/{key}")
+            running.add(asyncio.create_task(self._download_one(server, key, path)))
+
+        start_next()
+        try:
+            while running:
+                timeout = None
+                if candidates and len(running) == 1:
+                    timeout = self._hedge_delay()
+                done, _ = await asyncio.wait(running, timeout=timeout,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # First request is slow, race it against the next server.
+                    self.hedged += 1
+                    metrics.count("http_hedged")
+                    start_next()
+                    continue
+
+                winner = None
+                for t in done:
+                    running.discard(t)
+                    if t.exception() is None:
+                        if winner is not None and path is not None:
+                            os.unlink(t.result())  # Finished as well, the file of the winner is kept.
+                        winner = winner or t
+                    else:
+                        errors.append(t.exception())
+                if winner:
+                    if path is None:
+                        return winner.result()
+                    os.replace(winner.result(), path)
+                    return os.path.getsize(path)
+
+                if not running and candidates:
+                    start_next()
+        finally:
+            for t in running:
+                t.cancel()
+
+        raise BlossomError(f"could not download {key}: " + ", ".join(str(e) for e in errors))
@@ -6,8 +6,6 @@ try:
 except ImportError:
     from urlparse import urlparse
 
-from monstr.encrypt import Keys
-
 from git_remote_blossom import git
 from git_remote_blossom.util import Config, stderr
 from git_remote_blossom.helper import Helper
@@ -34,6 +32,7 @@ async def get_helper(remote_name, url):
     sk = None
     nsec = git.get_config_value("nostr.nsec") or git.get_config_value("nostr.sec")
     if nsec:
+        from monstr.encrypt import Keys
         if nsec.startswith("nsec1"):
             # Bech32 encoded secret key
             sk = Keys(nsec)
@@ -56,3 +55,20 @@ async def get_helper(remote_name, url):
         error('could not connect to relay')
 
     return helper
+
+
+async def get_local_helper(remote_name):
+    """
+    Return a Helper for the remote of the current repository, for commands
+    run by the user rather than by git.
+    """
+    if "GIT_DIR" not in os.environ:
+        try:
+            os.environ["GIT_DIR"] = git.command_output('rev-parse', '--absolute-git-dir')
+        except Exception:
+            error('not a git repository')
+    try:
+        url = git.get_remote_url(remote_name)
+    except Exception:
+        error(f'no such remote: {remote_name}')
+    return await get_helper(remote_name, url)
@@ -1,6 +1,9 @@
+import os
 import sys
 import asyncio
 
+from git_remote_blossom import git
+from git_remote_blossom.metrics import metrics
 from git_remote_blossom.util import Level, stdout_to_binary
 from git_remote_blossom.cli.common import error, get_helper
 
@@ -11,6 +14,8 @@ async def _main():
     """
     # configure system
     stdout_to_binary()
+    metrics.configure(os.environ.get('GIT_REMOTE_BLOSSOM_METRICS') or git.get_config_value('nostr.metrics'),
+                      git.get_config_value('nostr.metricsformat'))
 
     remote_name = sys.argv[1]
     url = sys.argv[2]
@@ -28,4 +33,19 @@ async def _main():
         exit(1)
 
 def main():
-    asyncio.run(_main())
+    # git runs us as "git-remote-blossom <remote> <url>".
+    if len(sys.argv) == 3 and sys.argv[1] == 'index' and '://' not in sys.argv[2]:
+        from git_remote_blossom.cli import index
+        index.main(sys.argv[2])
+        return
+    if len(sys.argv) == 3 and sys.argv[1] == 'snapshot' and '://' not in sys.argv[2]:
+        from git_remote_blossom.cli import snapshot
+        snapshot.main(sys.argv[2])
+        return
+
+    profile = os.environ.get('GIT_REMOTE_BLOSSOM_PROFILE')
+    if profile:
+        from git_remote_blossom import profiling
+        profiling.run(_main, profile)
+    else:
+        asyncio.run(_main())
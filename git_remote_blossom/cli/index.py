@@ -0,0 +1,26 @@
+import asyncio
+
+from git_remote_blossom.util import Level
+from git_remote_blossom.cli.common import error, get_local_helper
+
+
+async def _main(remote_name):
+    """
+    Rebuild the local blossom key index of a repository from its remote, so
+    that a clone made another way, or a wiped .git/blossom, can push again.
+
+    Usage: git-remote-blossom index <remote>
+    """
+    helper = await get_local_helper(remote_name)
+    try:
+        await helper.index()
+    except Exception as e:
+        if helper.verbosity >= Level.DEBUG:
+            raise
+        error(f'indexing failed: {e}')
+    finally:
+        await helper.close()
+
+
+def main(remote_name):
+    asyncio.run(_main(remote_name))
@@ -0,0 +1,27 @@
+import asyncio
+
+from git_remote_blossom.util import Level
+from git_remote_blossom.cli.common import error, get_local_helper
+
+
+async def _main(remote_name):
+    """
+    Store a pack of the whole history of a repository on blossom and name it
+    in the state event, so that clones download it at once and fetch only
+    newer objects one by one. Run it again now and then to cover new history.
+
+    Usage: git-remote-blossom snapshot <remote>
+    """
+    helper = await get_local_helper(remote_name)
+    try:
+        await helper.snapshot()
+    except Exception as e:
+        if helper.verbosity >= Level.DEBUG:
+            raise
+        error(f'snapshot failed: {e}')
+    finally:
+        await helper.close()
+
+
+def main(remote_name):
+    asyncio.run(_main(remote_name))
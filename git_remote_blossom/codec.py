@@ -0,0 +1,176 @@
+import zlib
+
+from git_remote_blossom.constants import COMPRESSION, DICT_SIZE, DICT_MIN_SAMPLES, INCOMPRESSIBLE_RATIO, \
+    DELTA_MAX_SIZE
+
+
+# The first byte of a payload names its codec. Payloads without a marker
+# are zlib streams, which always start with 0x78.
+RAW = 0x00
+ZSTD = 0x01
+ZSTD_DICT = 0x02  # followed by the 32-byte blossom key of the dictionary
+DELTA = 0x03  # followed by the chain depth, the delta and the 32-byte blossom key of the base
+ZLIB = 0x78
+
+CODECS = ('zlib', 'zstd', 'zstd-dict', 'none')
+
+# Object kinds compressed with the dictionary, which is trained on them.
+DICT_KINDS = ('commit', 'tree', 'tag')
+
+# Prefix compressed first to detect incompressible data, e.g. binaries.
+PROBE_SIZE = 1 << 16
+
+# Deltas are zstd frames using the base as a raw content dictionary. Below
+# this level, with the default hash tables, matches far into a large base
+# are not found.
+DELTA_LEVEL = 6
+
+
+class CodecError(Exception):
+    pass
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise CodecError("zstd compression needs the zstandard package: pip install zstandard")
+    return zstandard
+
+
+class Codec(object):
+    """
+    Compression of blossom payloads.
+
+    name is the codec used for uploads (see CODECS), downloads decode any of
+    them. With 'zstd-dict', commits, trees and tags are compressed with a
+    dictionary trained on such objects of the repo, which is stored as a blob
+    of its own and named by its blossom key in the payloads using it.
+
+    With deltas, blobs may be stored as a delta against another blob, their
+    base, which always uses zstd.
+    """
+
+    def __init__(self, name=COMPRESSION, level=None, deltas=False):
+        if name not in CODECS:
+            raise CodecError(f"Invalid nostr.compression value: {name}, use one of {', '.join(CODECS)}")
+        self.name = name
+        self.deltas = deltas
+        self._level = level
+        self._zstd = _zstandard() if name.startswith('zstd') or deltas else None
+        self._dicts = {}  # {blossom key: zstandard.ZstdCompressionDict}
+        self._dict_key = None  # Dictionary used for uploads.
+        self._compressors = {}
+        self._decompressors = {}
+
+    def has_dictionary(self, key):
+        return key in self._dicts
+
+    def add_dictionary(self, key, data):
+        """Register the dictionary stored under blossom key, for decoding."""
+        self._dicts[key] = _zstandard().ZstdCompressionDict(data)
+
+    def use_dictionary(self, key):
+        """Compress commits, trees and tags with a registered dictionary."""
+        self._dict_key = key
+
+    def train(self, samples):
+        """
+        Return a dictionary trained on samples (encoded objects), or None if
+        there are too few of them.
+        """
+        if len(samples) < DICT_MIN_SAMPLES:
+            return None
+        try:
+            return self._zstd.train_dictionary(DICT_SIZE, samples).as_bytes()
+        except self._zstd.ZstdError:
+            return None
+
+    def _compressor(self, dict_key):
+        if dict_key not in self._compressors:
+            level = self._level if self._level is not None else 3
+            if dict_key is None:
+                self._compressors[dict_key] = self._zstd.ZstdCompressor(level=level)
+            else:
+                self._compressors[dict_key] = self._zstd.ZstdCompressor(
+                    level=level, dict_data=self._dicts[dict_key])
+        return self._compressors[dict_key]
+
+    def _compress(self, data, kind):
+        if self.name == 'zlib':
+            return zlib.compress(data, self._level if self._level is not None else -1)
+        if self._dict_key is not None and kind in DICT_KINDS:
+            return bytes([ZSTD_DICT]) + self._dict_key + self._compressor(self._dict_key).compress(data)
+        return bytes([ZSTD]) + self._compressor(None).compress(data)
+
+    def encode(self, data, kind):
+        """Return the payload storing data, an encoded git object of kind."""
+        if self.name == 'none':
+            return bytes([RAW]) + data
+        if len(data) > PROBE_SIZE * 2:
+            # Don't spend CPU on compressing what does not compress.
+            probe = self._compress(data[:PROBE_SIZE], kind)
+            if len(probe) > PROBE_SIZE * INCOMPRESSIBLE_RATIO:
+                return bytes([RAW]) + data
+        payload = self._compress(data, kind)
+        if len(payload) > len(data):
+            return bytes([RAW]) + data
+        return payload
+
+    def encode_delta(self, data, base, base_key, depth):
+        """
+        Return the payload storing data as a delta against base, the encoded
+        object stored under blossom key base_key, at delta chain depth depth.
+        """
+        window_log = max(10, (len(base) + len(data)).bit_length())
+        params = self._zstd.ZstdCompressionParameters.from_level(
+            DELTA_LEVEL, window_log=window_log, hash_log=min(window_log, 25), chain_log=min(window_log, 25))
+        compressor = self._zstd.ZstdCompressor(
+            dict_data=self._zstd.ZstdCompressionDict(base, dict_type=self._zstd.DICT_TYPE_RAWCONTENT),
+            compression_params=params)
+        return bytes([DELTA, depth]) + compressor.compress(data) + base_key
+
+    def delta_base(self, payload):
+        """Return the blossom key of the base needed to decode payload, or None."""
+        if payload[0] == DELTA:
+            return payload[-32:]
+        return None
+
+    def dictionary_key(self, payload):
+        """Return the blossom key of the dictionary needed to decode payload, or None."""
+        if payload[0] == ZSTD_DICT:
+            return payload[1:33]
+        return None
+
+    def _decompressor(self, dict_key):
+        if dict_key not in self._decompressors:
+            zstd = _zstandard()
+            if dict_key is None:
+                self._decompressors[dict_key] = zstd.ZstdDecompressor()
+            else:
+                self._decompressors[dict_key] = zstd.ZstdDecompressor(dict_data=self._dicts[dict_key])
+        return self._decompressors[dict_key]
+
+    def decode(self, payload, base=None):
+        """Return the data stored in payload, with base the decoded base of deltas."""
+        marker = payload[0]
+        if marker == ZLIB:
+            return zlib.decompress(payload)
+        if marker == RAW:
+            return payload[1:]
+        if marker == ZSTD:
+            return self._decompressor(None).decompress(payload[1:])
+        if marker == ZSTD_DICT:
+            key = payload[1:33]
+            if key not in self._dicts:
+                raise CodecError(f"compression dictionary {key.hex()} is not loaded")
+            return self._decompressor(key).decompress(payload[33:])
+        if marker == DELTA:
+            if base is None:
+                raise CodecError("delta payload without its base")
+            zstd = _zstandard()
+            decompressor = zstd.ZstdDecompressor(
+                dict_data=zstd.ZstdCompressionDict(base, dict_type=zstd.DICT_TYPE_RAWCONTENT),
+                max_window_size=DELTA_MAX_SIZE)
+            return decompressor.decompress(payload[2:-32])
+        raise CodecError(f"unknown payload codec 0x{marker:02x}")
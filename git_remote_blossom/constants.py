@@ -4,3 +4,30 @@ import os
 DEVNULL = open(os.devnull, 'w')
 CONCURRENCY = 21
 MAX_RETRIES = 3
+RELAY_READ_MODE = 'first'  # 'first' or 'quorum'
+RELAY_PUBLISH_TIMEOUT = 10
+EWMA_ALPHA = 0.2
+HEDGE_PERCENTILE = 90
+HEDGE_MIN_SAMPLES = 20
+MAX_REF_SHARDS = 256
+KEY_MEMORY_LIMIT = 100000
+STALL_THRESHOLD = 0.05  # seconds the event loop may block before profiling reports it
+COMPRESSION = 'zlib'  # 'zlib', 'zstd', 'zstd-dict' or 'none'
+DICT_SIZE = 16 * 1024
+DICT_SAMPLES = 2000
+DICT_MIN_SAMPLES = 100
+INCOMPRESSIBLE_RATIO = 0.95
+SCHEDULER = 'priority'  # 'priority' or 'fifo'
+SCHEDULER_WINDOW = 10000  # blobs the push scheduler picks from
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 30  # seconds without receiving any data
+STALL_WINDOW = 10  # seconds over which transfer rates are checked
+STALL_MIN_RATE = 1024  # bytes/s below which a transfer counts as stalled
+RETRY_BACKOFF = 0.5  # seconds, doubled with every retry
+DELTA_MIN_SIZE = 8 * 1024  # smaller blobs are stored whole
+DELTA_MAX_SIZE = 1 << 27  # of a blob and its base together, the zstd window
+DELTA_MAX_DEPTH = 20
+DELTA_RATIO = 0.5  # deltas larger than this fraction of the blob are not used
+DELTA_CACHE_SIZE = 64 * 1024 * 1024
+DRY_RUN_SAMPLES = 200  # objects per kind compressed to estimate push sizes
+DRY_RUN_SAMPLE_BYTES = 32 * 1024 * 1024  # encoded per kind at most, larger objects are not sampled
@@ -0,0 +1,117 @@
+import asyncio
+import multiprocessing
+
+
+def _worker(conn, remote_name, path, verbosity, concurrency):
+    asyncio.run(_serve(conn, remote_name, path, verbosity, concurrency))
+
+
+async def _serve(conn, remote_name, path, verbosity, concurrency):
+    """
+    Download the objects sent by the coordinator, (sha, kind, blossom key),
+    and answer each with ('ok', sha, referenced) or ('error', sha, message).
+    """
+    from git_remote_blossom.helper import Helper
+    helper = Helper(remote_name, None, path, concurrency)
+    helper._verbosity = verbosity
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    tasks = set()
+
+    async def download(sha, kind, blossom_key):
+        try:
+            _, referenced = await helper._download(sha, kind, blossom_key)
+        except Exception as e:
+            conn.send(('error', sha, f'{e!r}'))
+        else:
+            conn.send(('ok', sha, referenced))
+
+    def on_message():
+        try:
+            message = conn.recv()
+        except EOFError:
+            message = None
+        if message is None:
+            loop.remove_reader(conn.fileno())
+            stopped.set()
+            return
+        task = asyncio.ensure_future(download(*message))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    loop.add_reader(conn.fileno(), on_message)
+    try:
+        await stopped.wait()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await helper.close()
+
+
+class FetchWorkers(object):
+    """
+    Processes downloading objects for the fetch of the helper.
+
+    Each worker has its own event loop, HTTP sessions and git processes, so
+    that decompression, hashing and HTTP parsing use more than one core. The
+    helper stays the coordinator: it owns the queue and the set of seen
+    objects, and hands single objects to the least busy worker.
+    """
+
+    def __init__(self, count, remote_name, path, verbosity, concurrency):
+        # Spawned, not forked: a fork would inherit the running event loop.
+        context = multiprocessing.get_context('spawn')
+        self._loop = asyncio.get_running_loop()
+        self._conns = []
+        self._processes = []
+        self._busy = {}  # {connection: downloads in flight}
+        self._futures = {}  # {sha: future resolved by the worker}
+        for _ in range(count):
+            conn, child_conn = context.Pipe()
+            p = context.Process(target=_worker, daemon=True,
+                                args=(child_conn, remote_name, path, verbosity, concurrency))
+            p.start()
+            child_conn.close()
+            self._conns.append(conn)
+            self._processes.append(p)
+            self._busy[conn] = 0
+            self._loop.add_reader(conn.fileno(), self._on_message, conn)
+
+    def _on_message(self, conn):
+        try:
+            status, sha, result = conn.recv()
+        except EOFError:
+            self._loop.remove_reader(conn.fileno())
+            error = Exception('fetch worker exited')
+            for future in self._futures.values():
+                if not future.done():
+                    future.set_exception(error)
+            return
+        self._busy[conn] -= 1
+        future = self._futures.pop(sha)
+        if status == 'ok':
+            future.set_result((sha, result))
+        else:
+            future.set_exception(Exception(result))
+
+    def download(self, sha, kind, blossom_key):
+        """Return a future of (sha, referenced), like Helper._download."""
+        conn = min(self._conns, key=self._busy.get)
+        self._busy[conn] += 1
+        future = self._loop.create_future()
+        self._futures[sha] = future
+        conn.send((sha, kind, blossom_key))
+        return future
+
+    def close(self):
+        for conn in self._conns:
+            self._loop.remove_reader(conn.fileno())
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            conn.close()
+        for p in self._processes:
+            p.join(5)
+            if p.is_alive():
+                p.terminate()
@@ -1,15 +1,25 @@
 from git_remote_blossom.constants import DEVNULL
+from git_remote_blossom.metrics import metrics
 
+import asyncio
+import hashlib
 import subprocess
 import zlib
 
 
+def _span(args):
+    """Record a git subprocess in the metrics."""
+    metrics.count('git_processes')
+    return metrics.span('git %s' % args[1], 'subprocess', ' '.join(args[2:])[:200])
+
+
 def command_output(*args, **kwargs):
     """
     Return the result of running a git command.
     """
     args = ('git',) + args
-    output = subprocess.check_output(args, stderr=DEVNULL)
+    with _span(args):
+        output = subprocess.check_output(args, stderr=DEVNULL)
     if kwargs.get('decode', True):
         output = output.decode('utf8')
     if kwargs.get('strip', True):
@@ -22,7 +32,37 @@ def command_ok(*args):
     Return whether a git command runs successfully.
     """
     args = ('git',) + args
-    return subprocess.call(args, stdout=DEVNULL, stderr=DEVNULL) == 0
+    with _span(args):
+        return subprocess.call(args, stdout=DEVNULL, stderr=DEVNULL) == 0
+
+
+def command_input(*args, **kwargs):
+    """
+    Return the output of a git command that reads kwargs['input'] from stdin.
+    """
+    args = ('git',) + args
+    with _span(args):
+        p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=DEVNULL)
+        return p.communicate(kwargs.get('input', b''))[0]
+
+
+def pack_objects(shas, out):
+    """
+    Write a pack of all objects reachable from the given objects to the file out.
+    """
+    args = ('git', 'pack-objects', '--revs', '--stdout', '-q')
+    with _span(args):
+        subprocess.run(args, input=''.join(sha + '\n' for sha in shas).encode(),
+                       stdout=out, stderr=DEVNULL, check=True)
+
+
+def index_pack(path):
+    """
+    Store the objects of the pack in the file path in the repository, verifying them.
+    """
+    args = ('git', 'index-pack', '--stdin')
+    with _span(args), open(path, 'rb') as pack:
+        subprocess.run(args, stdin=pack, stdout=DEVNULL, stderr=DEVNULL, check=True)
 
 
 def is_ancestor(ancestor, ref):
@@ -49,6 +89,23 @@ def history_exists(sha):
     return command_ok('rev-list', '--objects', sha)
 
 
+def histories_exist(shas, new_only=False):
+    """
+    Return whether the objects, along with their history, exist in the
+    repository. Checks all of them with a single git process.
+
+    With new_only, the walk stops at objects reachable from local refs, which
+    are complete already.
+    """
+    args = ('git', 'rev-list', '--objects', '--quiet', '--stdin')
+    if new_only:
+        args += ('--not', '--all')
+    with _span(args):
+        p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=DEVNULL, stderr=DEVNULL)
+        p.communicate(''.join(sha + '\n' for sha in shas).encode('utf8'))
+        return p.returncode == 0
+
+
 def ref_value(ref):
     """
     Return the hash of the ref.
@@ -82,6 +139,95 @@ def object_data(sha, kind=None):
         return command_output('cat-file', '-p', sha, decode=False, strip=False)
 
 
+def read_object(sha):
+    """
+    Return the type and the raw contents of the object as (kind, contents).
+    """
+    output = command_input('cat-file', '--batch', input=(sha + '\n').encode('utf8'))
+    header, contents = output.split(b'\n', 1)
+    header = header.decode('utf8').split()
+    if len(header) != 3:
+        raise Exception('object not found: %s' % sha)
+    return header[1], contents[:int(header[2])]
+
+
+def read_named_object(name):
+    """
+    Return (sha, kind, contents) of the object named by name, e.g.
+    "<commit>:<path>", or None if there is no such object.
+    """
+    output = command_input('cat-file', '--batch=%(objectname) %(objecttype) %(objectsize)',
+                           input=(name + '\n').encode('utf8'))
+    header, contents = output.split(b'\n', 1)
+    header = header.decode('utf8').split()
+    # Unknown names are answered with "<name> missing", and names may have spaces.
+    if len(header) != 3 or not header[2].isdigit():
+        return None
+    return header[0], header[1], contents[:int(header[2])]
+
+
+def read_objects(shas):
+    """
+    Return (kind, contents) of each of the objects, read with a single git process.
+    """
+    if not shas:
+        return []
+    output = command_input('cat-file', '--batch',
+                           input=''.join(sha + '\n' for sha in shas).encode('utf8'))
+    objects = []
+    pos = 0
+    for sha in shas:
+        end = output.index(b'\n', pos)
+        header = output[pos:end].decode('utf8').split()
+        if len(header) != 3:
+            raise Exception('object not found: %s' % sha)
+        size = int(header[2])
+        objects.append((header[1], output[end + 1:end + 1 + size]))
+        pos = end + 1 + size + 1
+    return objects
+
+
+class ObjectReader(object):
+    """
+    Reads objects through a single long-lived ``git cat-file --batch``.
+    """
+
+    def __init__(self):
+        args = ('git', 'cat-file', '--batch')
+        metrics.count('git_processes')
+        self._process = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, stderr=DEVNULL)
+
+    def read(self, sha):
+        """Return (kind, contents) of the object, or None if it does not exist."""
+        self._process.stdin.write((sha + '\n').encode('utf8'))
+        self._process.stdin.flush()
+        header = self._process.stdout.readline().decode('utf8').split()
+        if len(header) != 3:
+            return None
+        contents = self._process.stdout.read(int(header[2]) + 1)[:-1]
+        return header[1], contents
+
+    def close(self):
+        self._process.stdin.close()
+        self._process.wait()
+
+
+def hash_object(kind, contents, hash_len=20):
+    """
+    Return the binary object id of the object, computed in-process.
+    """
+    algorithm = 'sha256' if hash_len == 32 else 'sha1'
+    return hashlib.new(algorithm, encode_object_raw(kind, contents)).digest()
+
+
+def encode_object_raw(kind, contents):
+    """
+    Return the object in the encoding git uses for loose objects, uncompressed.
+    """
+    return kind.encode('utf8') + b' ' + str(len(contents)).encode('utf8') + b'\0' + contents
+
+
 def encode_object(sha):
     """
     Return the encoded contents of the object as bytearray.
@@ -90,13 +236,7 @@ def encode_object(sha):
 
     This operation is the inverse of `decode_object`, except it doesn't delete the file.
     """
-    kind = object_kind(sha)
-    size = command_output('cat-file', '-s', sha)
-    contents = object_data(sha, kind)
-    # size = len(contents)
-    return kind.encode('utf8') + b' ' + size.encode('utf8') + b'\0' + contents
-    # compressed = zlib.compress(data)
-    # return bytearray(compressed)
+    return encode_object_raw(*read_object(sha))
 
 
 def decode_object(data):
@@ -115,66 +255,161 @@ def decode_object_raw(kind, contents):
     """
     Write the object, and return the computed hash.
     """
-    p = subprocess.Popen(['git', 'hash-object', '-w', '--stdin', '-t', kind.decode('utf8')],
-                         stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                         stderr=DEVNULL)
-    sha = p.communicate(contents)[0].decode('utf8').strip()
-    return sha
+    if isinstance(kind, bytes):
+        kind = kind.decode('utf8')
+    output = command_input('hash-object', '-w', '--stdin', '-t', kind, input=contents)
+    return output.decode('utf8').strip()
 
 
-def list_objects(ref, exclude):
+def existing_objects(shas):
     """
-    Return the objects reachable from ref excluding the objects reachable from
-    exclude.
+    Return those of the objects that exist in the repository, checked with a
+    single git process.
     """
-    exclude = ['^%s' % obj for obj in exclude if object_exists(obj)]
-    objects = command_output('rev-list', '--topo-order', '--reverse', '--objects', ref, *exclude)
-    if not objects:
+    if not shas:
         return []
-    return [i.split()[0] for i in objects.split('\n')]
+    output = command_input('cat-file', '--batch-check=%(objectname)',
+                           input=''.join(sha + '\n' for sha in shas).encode('utf8'))
+    return [line for line in output.decode('utf8').split('\n') if line and not line.endswith(' missing')]
 
 
-def referenced_objects(sha):
+async def stream_objects(refs, exclude):
     """
-    Return the objects directly referenced by the object.
+    Yield (sha, kind, size, rest) of the objects reachable from refs excluding
+    the objects reachable from exclude, as git enumerates them. rest holds the
+    parents of commits, and the path of trees and blobs.
+
+    Commits come newest first, each followed by its new trees and blobs in
+    pre-order, and by the tags pointing at it.
     """
-    kind = object_kind(sha)
+    exclude = ['^%s' % obj for obj in existing_objects(exclude)]
+    rev_list_args = ('git', 'rev-list', '--topo-order', '--in-commit-order', '--objects', '--parents',
+                     '--stdin')
+    cat_file_args = ('git', 'cat-file', '--batch-check=%(objectname) %(objecttype) %(objectsize) %(rest)')
+    metrics.count('git_processes', 2)
+    with metrics.span('git rev-list', 'subprocess', 'streaming'):
+        rev_list = subprocess.Popen(rev_list_args, stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE, stderr=DEVNULL)
+        # rev-list reads all of its input before it starts the walk.
+        rev_list.stdin.write(''.join(arg + '\n' for arg in refs + exclude).encode('utf8'))
+        rev_list.stdin.close()
+        # cat-file reads the output of rev-list directly and adds the kinds.
+        cat_file = await asyncio.create_subprocess_exec(
+            *cat_file_args, stdin=rev_list.stdout, stdout=subprocess.PIPE, stderr=DEVNULL)
+        rev_list.stdout.close()
+        try:
+            async for line in cat_file.stdout:
+                sha, kind, size, rest = line.decode('utf8').rstrip('\n').split(' ', 3)
+                yield sha, kind, int(size), rest
+            await cat_file.wait()
+        finally:
+            if cat_file.returncode is None:
+                cat_file.kill()
+                await cat_file.wait()
+            if rev_list.poll() is None:
+                rev_list.kill()
+            rev_list.wait()
+        if rev_list.returncode != 0 or cat_file.returncode != 0:
+            raise Exception('git rev-list failed to enumerate objects')
+
+
+def parse_references(kind, contents, hash_len=20):
+    """
+    Return the objects directly referenced by the raw object contents as a
+    list of (sha, kind) tuples.
+
+    The contents are parsed in-process, the order is the same as in the
+    output of `git cat-file -p`.
+    """
+    if isinstance(kind, bytes):
+        kind = kind.decode('utf8')
+
     if kind == 'blob':
         # blob objects do not reference any other objects
         return []
-    data = object_data(sha).decode('utf8').strip()
-    if kind == 'tag':
-        # tag objects reference a single object
-        obj = data.split('\n')[0].split()[1]
-        return [obj]
+    elif kind == 'tag':
+        # tag objects reference a single object, its type is on the second line
+        lines = contents.split(b'\n', 2)
+        return [(lines[0].split()[1].decode('utf8'), lines[1].split()[1].decode('utf8'))]
     elif kind == 'commit':
         # commit objects reference a tree and zero or more parents
-        lines = data.split('\n')
-        tree = lines[0].split()[1]
-        objs = [tree]
+        lines = contents.split(b'\n')
+        objs = [(lines[0].split()[1].decode('utf8'), 'tree')]
         for line in lines[1:]:
-            if line.startswith('parent '):
-                objs.append(line.split()[1])
+            if line.startswith(b'parent '):
+                objs.append((line[7:].decode('utf8'), 'commit'))
             else:
                 break
         return objs
     elif kind == 'tree':
-        # tree objects reference zero or more trees and blobs, or submodules
-        lines = data.split('\n')
-        # submodules have the mode '160000' and the kind 'commit', we filter them out because
-        # there is nothing to download and this causes errors
-        return [line.split()[2] for line in lines if not line.startswith('160000 commit ')]
+        # tree entries are "<mode> <name>\0<binary hash>"
+        objs = []
+        pos = 0
+        while pos < len(contents):
+            space = contents.index(b' ', pos)
+            nul = contents.index(b'\0', space)
+            mode = contents[pos:space]
+            sha = contents[nul + 1:nul + 1 + hash_len].hex()
+            pos = nul + 1 + hash_len
+            # submodules have the mode '160000' and the kind 'commit', we filter them out because
+            # there is nothing to download and this causes errors
+            if mode == b'160000':
+                continue
+            objs.append((sha, 'tree' if mode == b'40000' else 'blob'))
+        return objs
     else:
         raise Exception('unexpected git object type: %s' % kind)
 
 
+def referenced_objects(sha, hash_len=20):
+    """
+    Return the objects directly referenced by the object.
+    """
+    kind, contents = read_object(sha)
+    return [ref for (ref, _) in parse_references(kind, contents, hash_len)]
+
+
 def get_remote_url(name):
     """Return the URL of the given remote."""
     return command_output('remote', 'get-url', name)
 
+_config = None
+
+
+def _config_key(key):
+    """Normalize a config key the way git does: section and name are case-insensitive."""
+    section, _, rest = key.partition('.')
+    subsection, _, name = rest.rpartition('.')
+    if subsection:
+        return '%s.%s.%s' % (section.lower(), subsection, name.lower())
+    return '%s.%s' % (section.lower(), name.lower())
+
+
+def _read_config():
+    """
+    Return the whole git config as {key: [values]}, read once per process.
+    """
+    global _config
+    if _config is None:
+        _config = {}
+        try:
+            output = command_output('config', '-z', '--list', decode=False, strip=False)
+        except subprocess.CalledProcessError:
+            output = b''
+        for entry in output.split(b'\0'):
+            if not entry:
+                continue
+            key, _, value = entry.decode('utf8').partition('\n')
+            _config.setdefault(_config_key(key), []).append(value)
+    return _config
+
+
 def get_config_value(key):
     """Return value for passed key, return None if config does not exist"""
-    try:
-        return command_output('config', '--get', key)
-    except subprocess.CalledProcessError:
-        return None
+    values = _read_config().get(_config_key(key))
+    return values[-1] if values else None
+
+
+def get_config_values(key):
+    """Return all values for a multi-valued key, empty list if config does not exist"""
+    return list(_read_config().get(_config_key(key), []))
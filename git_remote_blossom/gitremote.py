@@ -2,14 +2,14 @@ import os
 import sys
 import json
 import time
+import hashlib
 import asyncio
 from datetime import datetime
 
-from monstr.encrypt import Keys
-from monstr.event.event import Event
-from monstr.client.client import Client
-
 from git_remote_blossom import git
+from git_remote_blossom.constants import RELAY_READ_MODE, RELAY_PUBLISH_TIMEOUT, MAX_REF_SHARDS
+from git_remote_blossom.keyindex import KeyIndex
+from git_remote_blossom.metrics import metrics
 from git_remote_blossom.util import stderr, Level
 
 
@@ -20,22 +20,60 @@ class GitRemoteError(Exception):
 
 
 class GitRemote:
+    """
+    Refs of a repository, stored in nostr state events.
+
+    All refs live in an in-memory index. On the relays they are stored in the
+    main state event (d=<repo>), or, if the repo is sharded (``shards`` tag in
+    the main event), refs outside of refs/heads/ are spread by hash over
+    shard events (d=<repo>:<shard>). Only changed events are re-published.
+    """
     def __init__(self, path, remote_name, sk, verbosity):
         self._path = path
         self._sk = sk
         self._state_event = None
+        self._read_complete = False  # Whether the state was read from every relay.
+        self._shard_events = {}  # {shard: Event}
+        self._refs = {}  # {refname: (sha, blossom_key)}
+        self._symrefs = {}  # {name: refname}
+        self._dictionary = None  # Blossom key of the zstd compression dictionary.
+        self._snapshot = None  # (blossom key of a pack, number of commits it covers)
+        self._shards = 0
+        self._dirty = set()  # Shards to publish, "" is the main state event.
         self._remote_npub, self._repo = path.split("/")
-        self._remote_pubkey = Keys(pub_k=self._remote_npub).public_key_hex()
+        self._pubkey = None
         self._git_dir = os.environ['GIT_DIR']
+        self._keys = KeyIndex(self._git_dir)
         self._remote_name = remote_name
         self._verbosity = verbosity
-        self._relay = git.get_config_value("nostr.relay")
+        self._relays = git.get_config_values("nostr.relay")
         self._objectformat = git.get_config_value("extensions.objectformat") or "sha1"
-        if not self._relay:
+        if not self._relays:
             raise Exception("Relay must be set via 'git config --global --add nostr.relay wss://relay.for.repos'")
 
+        # 'first' returns the first relay response that holds a state event,
+        # 'quorum' waits for nostr.relayquorum relays (default: majority).
+        self._read_mode = git.get_config_value("nostr.relayread") or RELAY_READ_MODE
+        if self._read_mode not in ("first", "quorum"):
+            raise GitRemoteError(f"Invalid nostr.relayread value: {self._read_mode}")
+        quorum = git.get_config_value("nostr.relayquorum")
+        self._read_quorum = int(quorum) if quorum else len(self._relays) // 2 + 1
+        self._read_quorum = max(1, min(self._read_quorum, len(self._relays)))
+
+        shards = git.get_config_value("nostr.refshards")
+        # Without nostr.refshards, the shard count of the remote is kept.
+        self._wanted_shards = min(int(shards), MAX_REF_SHARDS) if shards else None
+
+    @property
+    def _remote_pubkey(self):
+        if self._pubkey is None:
+            # monstr is imported on first use, it pulls in the crypto and network stacks.
+            from monstr.encrypt import Keys
+            self._pubkey = Keys(pub_k=self._remote_npub).public_key_hex()
+        return self._pubkey
+
     async def connect(self):
-        #WE_ARE_HERE: Find k:30617 repo announcement event on self._relay.
+        #WE_ARE_HERE: Find k:30617 repo announcement event on self._relays.
         # If exists, use relays and blossoms from that event instead.
         pass
 
@@ -47,8 +85,8 @@ class GitRemote:
             Its keys are refnames,
             values are tuple of (sha1, blossom_key).
         """
-        if self._state_event is None:
-            await self._fetch_state_event()
+        if self._state_event is None or for_push and not self._read_complete:
+            await self._fetch_state_event(complete=for_push)
 
         if self._state_event is None:
             if not for_push:
@@ -56,113 +94,356 @@ class GitRemote:
             else:
                 return True, {}
 
-        refs = {}
-        for t in self._state_event.tags:
-            if t[0] == "ref":
-                refname = "refs/" + t[1]
-                sha = t[2]
-                refs[refname] = (sha, t[3])
+        return False, dict(self._refs)
+
+    def _shard_d(self, shard):
+        return f"{self._repo}:{shard}" if shard else self._repo
 
-        return False, refs
+    def _shard_of(self, ref):
+        """Return the shard holding ref, "" for the main state event."""
+        if not self._shards or ref.startswith("refs/heads/"):
+            return ""
+        h = hashlib.sha256(ref.encode()).digest()
+        return "%02x" % (int.from_bytes(h[:4], "big") % self._shards)
 
-    async def _fetch_state_event(self):
+    def _all_shards(self):
+        return ["%02x" % i for i in range(self._shards)]
+
+    async def _query_relay(self, relay, filters):
+        """
+        Return events matching filters on a single relay,
+        or None if the relay could not be queried.
+        """
+        from monstr.client.client import Client
         try:
-            async with Client(self._relay) as c:
-                evs = await c.query({
-                    "kinds": [STATE_KIND],
-                    "authors": [self._remote_pubkey],
-                    "#d": [self._repo]
-                })
-                if len(evs) == 0:
-                    self._trace(
-                        f"Git repo state event not found on relay [{self._relay}].",
-                        level=Level.INFO)
-                    return
+            with metrics.span("relay query", "relay", relay):
+                async with Client(relay) as c:
+                    return await c.query(filters)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._trace(f"Cannot query relay [{relay}]: {str(e)}", level=Level.INFO)
+            return None
 
-                assert len(evs) == 1, evs
-                self._state_event = evs[0]
+    def _is_valid_state_event(self, ev, d_tags):
+        return ev.kind == STATE_KIND and \
+            ev.pub_key == self._remote_pubkey and \
+            ev.get_tag_value_pos("d") in d_tags and \
+            ev.is_valid()
 
-        except ConnectionError as e:
-            self._trace(f"Cannot connect to relay [{self._relay}]: {str(e)}", level=Level.INFO)
+    async def _query_newest(self, d_tags, complete=False):
+        """
+        Query all relays in parallel and return the newest valid event for
+        each of the d_tags as a {d: event} dict.
+
+        In 'first' mode we return as soon as every d tag has been delivered by
+        some relay, in 'quorum' mode we wait until enough relays have answered.
+        With complete, every relay is waited for.
+        """
+        filters = {
+            "kinds": [STATE_KIND],
+            "authors": [self._remote_pubkey],
+            "#d": d_tags
+        }
+        tasks = [asyncio.create_task(self._query_relay(r, filters)) for r in self._relays]
+        responses = 0
+        newest = {}
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                evs = await next_done
+                if evs is None:
+                    continue
+                responses += 1
+
+                for ev in evs:
+                    if not self._is_valid_state_event(ev, d_tags):
+                        self._trace(f"Ignoring invalid state event {ev.id}.")
+                        continue
+                    d = ev.get_tag_value_pos("d")
+                    if d not in newest or ev.created_at_ticks > newest[d].created_at_ticks:
+                        newest[d] = ev
+
+                if complete:
+                    continue
+                if self._read_mode == "first" and len(newest) == len(d_tags):
+                    break
+                if self._read_mode == "quorum" and responses >= self._read_quorum:
+                    break
+        finally:
+            for t in tasks:
+                t.cancel()
+
+        if responses == 0:
+            self._trace(f"Cannot connect to any relay of [{', '.join(self._relays)}].",
+                        level=Level.INFO)
             raise SystemExit(1)
 
-    async def _publish_state_event(self):
-        self._trace("STATE EVENT", level=Level.INFO)
-        self._trace(self._state_event.tags.tags, level=Level.INFO)
-        # created_at is converted to datetime.datetime in setter.
-        old_created_at = self._state_event.created_at
-        self._state_event.created_at = int(time.time())
-        if old_created_at == self._state_event.created_at:
+        return newest
+
+    async def _fetch_state_event(self, complete=False):
+        """
+        Read the main state event and its shards into the ref index.
+
+        Reads before a publish are complete, from every relay whatever
+        nostr.relayread says: the events published replace those of all
+        relays, so they must not be built on a stale relay that answered first.
+        """
+        with metrics.phase("relay read"):
+            await self.__fetch_state_event(complete)
+
+    async def __fetch_state_event(self, complete):
+        # Read again from scratch if an incomplete read came first.
+        self._state_event = None
+        self._shard_events = {}
+        self._refs = {}
+        self._symrefs = {}
+        self._dictionary = self._snapshot = None
+        self._shards = 0
+        evs = await self._query_newest([self._repo], complete)
+        self._read_complete = complete
+        if not evs:
+            self._trace("Git repo state event not found on relays.", level=Level.INFO)
+            return
+
+        self._state_event = evs[self._repo]
+        self._shards = int(self._state_event.get_tag_value_pos("shards", default="0"))
+        self._load_refs(self._state_event)
+        if not self._shards:
+            return
+
+        d_tags = [self._shard_d(shard) for shard in self._all_shards()]
+        for d, ev in (await self._query_newest(d_tags, complete)).items():
+            self._shard_events[d.rsplit(":", 1)[1]] = ev
+            self._load_refs(ev)
+
+    def _load_refs(self, ev):
+        for t in ev.tags:
+            if t[0] == "ref":
+                self._refs["refs/" + t[1]] = (t[2], t[3])
+            elif t[0] == "symref":
+                assert t[2].startswith("ref: ")
+                self._symrefs[t[1]] = t[2][5:]
+            elif t[0] == "dictionary":
+                self._dictionary = t[1]
+            elif t[0] == "snapshot" and len(t) == 3 and t[2].isdigit():
+                self._snapshot = (t[1], int(t[2]))
+
+    def _shard_tags(self, shard):
+        """Return the tags of the event for shard, built from the ref index."""
+        tags = [["d", self._shard_d(shard)]]
+        if not shard:
+            # Keep tags that we don't manage ourselves.
+            tags.extend(t for t in self._state_event.tags
+                        if t[0] not in ("d", "ref", "symref", "shards", "dictionary", "snapshot"))
+            if self._shards:
+                tags.append(["shards", str(self._shards)])
+            if self._dictionary:
+                tags.append(["dictionary", self._dictionary])
+            if self._snapshot:
+                tags.append(["snapshot", self._snapshot[0], str(self._snapshot[1])])
+            for name, ref in self._symrefs.items():
+                tags.append(["symref", name, f"ref: {ref}"])
+
+        for ref, (sha, blossom_key) in self._refs.items():
+            if self._shard_of(ref) == shard:
+                tags.append(["ref", ref[5:], sha, blossom_key])
+        return tags
+
+    def _reshard(self):
+        """Switch to the shard count configured in nostr.refshards."""
+        if self._wanted_shards is None or self._wanted_shards == self._shards:
+            return
+        self._trace(f"Resharding refs from {self._shards} to {self._wanted_shards} shards.",
+                    level=Level.INFO)
+        self._shards = self._wanted_shards
+        # Every event changes. Shards beyond the new count are left behind
+        # on the relays, readers ignore them.
+        self._dirty.add("")
+        self._dirty.update(self._all_shards())
+
+    async def _publish_to_relay(self, relay, events):
+        """
+        Publish events to a single relay.
+
+        Return a list with an item for each event: True if the relay accepted
+        it, False if it rejected it or was unreachable, None if it did not
+        answer in time.
+        """
+        from monstr.client.client import Client
+        answers = {ev.id: asyncio.get_running_loop().create_future() for ev in events}
+
+        def on_ok(client, event_id, success, msg):
+            if event_id in answers and not answers[event_id].done():
+                answers[event_id].set_result((success, msg))
+
+        try:
+            with metrics.span("relay publish", "relay", relay):
+                async with Client(relay, on_ok=on_ok) as c:
+                    for ev in events:
+                        c.publish(ev)
+                    await asyncio.wait(answers.values(), timeout=RELAY_PUBLISH_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._trace(f"Cannot publish to relay [{relay}]: {str(e)}", level=Level.INFO)
+            return [False] * len(events)
+
+        results = []
+        for ev in events:
+            answer = answers[ev.id]
+            if not answer.done():
+                results.append(None)
+                continue
+            success, msg = answer.result()
+            if not success:
+                self._trace(f"Relay [{relay}] rejected state event: {msg}", level=Level.INFO)
+            results.append(success)
+        return results
+
+    async def _publish_events(self, events):
+        """
+        Fan out events to all relays, it is enough if any of them takes each.
+
+        A relay that does not answer in time may or may not have taken an
+        event, so only explicit acceptances count.
+        """
+        if not events:
+            return
+        results = await asyncio.gather(*[self._publish_to_relay(r, events) for r in self._relays])
+        timed_out = [relay for relay, res in zip(self._relays, results) if None in res]
+        if timed_out:
+            self._trace(f"No answer in time from relay [{', '.join(timed_out)}] to publish.",
+                        level=Level.INFO)
+        for i, ev in enumerate(events):
+            if not any(res[i] is True for res in results):
+                raise GitRemoteError("State event was not accepted by any relay.")
+
+    def _sign_shard(self, shard):
+        if shard:
+            ev = self._shard_events.get(shard)
+            if ev is None:
+                from monstr.event.event import Event
+                ev = Event(pub_key=self._sk.public_key_hex(), kind=STATE_KIND)
+                self._shard_events[shard] = ev
+        else:
+            ev = self._state_event
+
+        ev.tags = self._shard_tags(shard)
+        old_created_at = ev.created_at_ticks
+        ev.created_at = int(time.time())
+        if old_created_at >= ev.created_at_ticks:
             # We need newer created_at to replace previous event.
-            self._state_event.created_at = int(time.time()) + 1
+            ev.created_at = old_created_at + 1
 
-        self._state_event.sign(self._sk.private_key_hex())
+        ev.sign(self._sk.private_key_hex())
+        self._trace(f"Publishing state event {self._shard_d(shard)}: {ev.tags.tags}")
+        return ev
 
-        async with Client(self._relay) as c:
-            c.publish(self._state_event)
-            await asyncio.sleep(1)
-            #FIXME: make publish() wait for the relay's response.
+    async def _publish_state_event(self):
+        """Publish the state events of the changed shards."""
+        self._reshard()
+        dirty, self._dirty = self._dirty, set()
+        metrics.count("state_events_published", len(dirty))
+        with metrics.phase("relay publish"):
+            # Shards go first, so that readers of the main event find them.
+            await self._publish_events([self._sign_shard(shard) for shard in sorted(dirty) if shard])
+            if "" in dirty:
+                await self._publish_events([self._sign_shard("")])
 
     def get_ref(self, ref):
         assert self._state_event, "No state event"
 
-        for t in self._state_event.tags:
-            if t[0] == "ref" and t[1] == ref[5:]:
-                self._write_blossom_key(t[2], bytes.fromhex(t[3]))
-                return t[2]
+        if ref not in self._refs:
+            return None
 
-        return None
+        sha, blossom_key = self._refs[ref]
+        self._write_blossom_key(sha, bytes.fromhex(blossom_key))
+        return sha
 
     def set_ref(self, ref, sha):
         assert ref.startswith("refs/"), ref
 
         blossom_key = self._read_blossom_key(sha)
-
-        for t in self._state_event.tags:
-            if t[0] == "ref" and t[1] == ref[5:]:
-                t[2] = sha
-                t[3] = blossom_key.hex()
-                return
-
-        self._state_event.tags.tags.append(["ref", ref[5:], sha, blossom_key.hex()])
+        self._refs[ref] = (sha, blossom_key.hex())
+        self._dirty.add(self._shard_of(ref))
 
     def set_symref(self, symref, ref):
-        for t in self._state_event.tags:
-            if t[0] == "symref" and t[1] == symref:
-                t[2] = f"ref: {ref}"
-                return
-
-        self._state_event.tags.tags.append(["symref", symref, f"ref: {ref}"])
+        self._symrefs[symref] = ref
+        self._dirty.add("")
 
-    async def write_ref(self, new_sha, dst, force=False):
+    async def update_ref(self, new_sha, dst, force=False):
         """
-        Update the given reference to point to the given object.
+        Update the given reference in memory to point to the given object.
+        Changes are sent to the relays by `publish`.
 
         Return None if there is no error, otherwise return a description of the
         error.
         """
         assert dst.startswith("refs/"), dst
-        self._trace(f"write_ref(new_sha={new_sha}, dst={dst}, force={force})")
+        self._trace(f"update_ref(new_sha={new_sha}, dst={dst}, force={force})")
 
-        if self._state_event is None:
-            await self._fetch_state_event()
+        if self._state_event is None or not self._read_complete:
+            await self._fetch_state_event(complete=True)
         if self._state_event is None:
             self._create_state_event()
 
-        if not force:
-            sha = self.get_ref(dst)
+        if not force and dst in self._refs:
+            # Indexes the key of its current value, which the pushed objects likely reference.
+            self.get_ref(dst)
+        error = self.check_ref(new_sha, dst, force)
+        if error is None:
+            self.set_ref(dst, new_sha)
+        return error
+
+    def check_ref(self, new_sha, dst, force=False):
+        """
+        Return the error updating the given reference would give, or None.
+        Only reads the state, the key index is left alone.
+        """
+        if not force and dst in self._refs:
+            sha, _ = self._refs[dst]
             if sha:
                 if not git.object_exists(sha):
                     return 'fetch first'
                 is_fast_forward = git.is_ancestor(sha, new_sha)
                 if not is_fast_forward:
                     return 'non-fast-forward'
+        return None
+
+    def count_events(self, refs):
+        """
+        Return the number of state events publishing updates of the given
+        refs would send to each relay.
+        """
+        if self._wanted_shards is not None and self._wanted_shards != self._shards:
+            return 1 + self._wanted_shards
+        dirty = set(self._dirty)
+        dirty.update(self._shard_of(ref) for ref in refs)
+        if self._state_event is None:
+            dirty.add("")
+        return len(dirty)
 
-        self.set_ref(dst, new_sha)
+    def relay_count(self):
+        return len(self._relays)
 
+    async def publish(self):
+        """Send all ref updates made since the last publish to the relays."""
         await self._publish_state_event()
 
+    async def write_ref(self, new_sha, dst, force=False):
+        """
+        Update the given reference to point to the given object.
+
+        Return None if there is no error, otherwise return a description of the
+        error.
+        """
+        error = await self.update_ref(new_sha, dst, force)
+        if error is None:
+            await self.publish()
+        return error
+
     def _create_state_event(self):
+        from monstr.event.event import Event
         self._state_event = Event(
             pub_key=self._sk.public_key_hex(),
             tags=[
@@ -170,14 +451,37 @@ class GitRemote:
             ],
             kind=STATE_KIND
         )
+        self._dirty.add("")
+
+    def get_dictionary(self):
+        """Return the hex blossom key of the compression dictionary, or None."""
+        return self._dictionary
+
+    def set_dictionary(self, key):
+        """Name the compression dictionary in the state event, published with the next refs."""
+        if self._state_event is None:
+            self._create_state_event()
+        self._dictionary = key
+        self._dirty.add("")
+
+    def get_snapshot(self):
+        """Return (hex blossom key, number of commits covered) of the snapshot pack, or None."""
+        return self._snapshot
+
+    def set_snapshot(self, key, count):
+        """Name the snapshot pack and the number of commits it covers, published with the next refs."""
+        if self._state_event is None:
+            self._create_state_event()
+        self._snapshot = (key, count)
+        self._dirty.add("")
 
     async def write_symbolic_ref(self, name, ref):
         """Write the given symbolic ref to the remote.
         Return None if there is no error, otherwise return a description of the error.
         """
         self._trace(f"write_symbolic_ref({name}, {ref})")
-        if self._state_event is None:
-            await self._fetch_state_event()
+        if self._state_event is None or not self._read_complete:
+            await self._fetch_state_event(complete=True)
         if self._state_event is None:
             self._create_state_event()
 
@@ -193,12 +497,7 @@ class GitRemote:
         if self._state_event is None:
             await self._fetch_state_event()
 
-        for t in self._state_event.tags:
-            if t[0] == "symref" and t[1] == path:
-                assert t[2].startswith("ref: ")
-                return t[2][5:]
-
-        return None
+        return self._symrefs.get(path)
 
     def _trace(self, message, level=Level.DEBUG, exact=False):
         """
@@ -219,22 +518,9 @@ class GitRemote:
         elif level >= Level.DEBUG:
             stderr('debug: %s\n' % message)
 
-    def _blossom_path(self, sha):
-        # sha is in hex
-        prefix = sha[:2]
-        suffix = sha[2:]
-        return os.path.join(self._git_dir, "blossom", prefix, suffix)
-
     def _read_blossom_key(self, sha):
         # Takes hex sha1, returns binary sha256
-        path = self._blossom_path(sha)
-        if not os.path.exists(path):
-            return None
-        return open(path, "rb").read()
+        return self._keys.read(bytes.fromhex(sha))
 
     def _write_blossom_key(self, sha, blossom_key):
-        path = self._blossom_path(sha)
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path + ".tmp", "wb") as f:
-            f.write(blossom_key)
-        os.rename(path + ".tmp", path)
+        self._keys.write(bytes.fromhex(sha), blossom_key)
@@ -1,7 +1,3 @@
-import multiprocessing
-import multiprocessing.dummy
-import multiprocessing.pool
-import posixpath
 import asyncio
 import os
 import hashlib
@@ -9,15 +5,20 @@ import base64
 import json
 import random
 import sys
-import zlib
-import aiohttp
-from aiohttp.client_exceptions import ClientConnectorError
-from monstr.event.event import Event
+import tempfile
+from collections import OrderedDict
 
-from git_remote_blossom.constants import CONCURRENCY, MAX_RETRIES
-from git_remote_blossom.util import readline, Level, stdout, stderr, Poison
+from git_remote_blossom.constants import CONCURRENCY, HEDGE_PERCENTILE, KEY_MEMORY_LIMIT, \
+    COMPRESSION, DICT_SAMPLES, SCHEDULER, SCHEDULER_WINDOW, DELTA_MIN_SIZE, DELTA_MAX_SIZE, DELTA_MAX_DEPTH, \
+    DELTA_RATIO, DELTA_CACHE_SIZE, DRY_RUN_SAMPLES, DRY_RUN_SAMPLE_BYTES
+from git_remote_blossom.util import readline, Level, stdout, stderr
 from git_remote_blossom import git
+from git_remote_blossom.blossom import BlossomPool
+from git_remote_blossom.codec import Codec, CodecError
+from git_remote_blossom.scheduler import SCHEDULERS
 from git_remote_blossom.gitremote import GitRemote, GitRemoteError
+from git_remote_blossom.keyindex import KeyIndex, ShaSet, UNKNOWN_DEPTH
+from git_remote_blossom.metrics import metrics
 
 
 class Helper(object):
@@ -30,13 +31,47 @@ class Helper(object):
         self._refs = {}  # {refname: (sha, blossom_key)}
         self._pushed = {}  # Same, but just pushed (?).
         self._first_push = False
+        self._cloning = False  # The local repository is empty, nothing to probe.
+        self._check_connectivity = False
+        self._dry_run = False
         self._remote = None
         self._semaphore = asyncio.Semaphore(self._concurrency)
         self._git_dir = os.environ["GIT_DIR"]
-        self._blossom_server = git.get_config_value("nostr.blossom")
+        quorum = git.get_config_value("nostr.blossomquorum")
+        hedge = git.get_config_value("nostr.hedgepercentile")
+        self._blossom = BlossomPool(
+            git.get_config_values("nostr.blossom"), self._trace,
+            write_quorum=int(quorum) if quorum else None,
+            hedge_percentile=int(hedge) if hedge else HEDGE_PERCENTILE)
         self._objectformat = git.get_config_value("extensions.objectformat") or "sha1"
-        self._have_blossom_key = dict()
-        self._blossom_keys = {}
+        self._hash_len = 32 if self._objectformat == "sha256" else 20
+        keymemory = git.get_config_value("nostr.keymemory")
+        self._keys = KeyIndex(self._git_dir, int(keymemory) if keymemory else KEY_MEMORY_LIMIT)
+        # Futures of started uploads, resolved and dropped once their blossom key is known.
+        self._key_waiters = {}
+        self._uploads = set()  # Running upload tasks.
+        self._pushing = ShaSet(self._hash_len)  # Objects listed for upload by this push.
+        self._started = ShaSet(self._hash_len)  # Objects whose upload has started.
+        level = git.get_config_value("nostr.compressionlevel")
+        deltas = (git.get_config_value("nostr.deltas") or "").lower() in ("true", "yes", "on", "1")
+        try:
+            self._codec = Codec(git.get_config_value("nostr.compression") or COMPRESSION,
+                                int(level) if level else None, deltas)
+        except CodecError as e:
+            self._fatal(str(e))
+        self._delta_bases = {}  # {binary sha of a blob not stored yet: name of its version in the parent commit}
+        self._depths = {}  # {binary sha: delta chain depth} of objects pushed now
+        self._bases = OrderedDict()  # {blossom key: decoded blob}, recently loaded delta bases
+        self._bases_size = 0
+        self._loads = {}  # {blossom key: task}, downloads in flight
+        self._dictionaries = {}  # {blossom key: task loading the dictionary}
+        scheduler = git.get_config_value("nostr.scheduler") or SCHEDULER
+        if scheduler not in SCHEDULERS:
+            self._fatal(f"Invalid nostr.scheduler value: {scheduler}, use one of {', '.join(SCHEDULERS)}")
+        self._scheduler = SCHEDULERS[scheduler]
+        workers = git.get_config_value("nostr.fetchworkers")
+        self._fetch_workers = int(workers) if workers else 1
+        self._workers = None  # FetchWorkers, started by the first download.
 
     @property
     def verbosity(self):
@@ -88,6 +123,21 @@ class Helper(object):
         """
         Run the helper following the git remote helper communication protocol.
         """
+        try:
+            await self._run()
+        finally:
+            await self.close()
+
+    async def close(self):
+        if self._workers is not None:
+            self._workers.close()
+        await self._blossom.close()
+        pool = self._blossom
+        if pool.retries or pool.stalls or pool.hedged:
+            self._trace(f"blossom: {pool.retries} retries, {pool.stalls} stalled transfers, "
+                        f"{pool.hedged} hedged downloads\n", Level.INFO, exact=True)
+
+    async def _run(self):
         while True:
             line = readline()
             if line:
@@ -95,17 +145,21 @@ class Helper(object):
 
             if line == 'capabilities':
                 self._write('option')
+                self._write('check-connectivity')
                 self._write('push')
                 self._write('fetch')
                 self._write()
             elif line.startswith('option'):
                 self._do_option(line)
             elif line.startswith('list'):
-                await self._do_list(line)
+                with metrics.phase('list'):
+                    await self._do_list(line)
             elif line.startswith('push'):
-                await self._do_push(line)
+                with metrics.phase('push'):
+                    await self._do_push(line)
             elif line.startswith('fetch'):
-                await self._do_fetch(line)
+                with metrics.phase('fetch'):
+                    await self._do_fetch(line)
             elif line == '':
                 break
             else:
@@ -118,6 +172,15 @@ class Helper(object):
         if line.startswith('option verbosity'):
             self._verbosity = int(line[len('option verbosity '):])
             self._write('ok')
+        elif line.startswith('option cloning '):
+            self._cloning = line[len('option cloning '):] == 'true'
+            self._write('ok')
+        elif line.startswith('option check-connectivity '):
+            self._check_connectivity = line[len('option check-connectivity '):] == 'true'
+            self._write('ok')
+        elif line.startswith('option dry-run '):
+            self._dry_run = line[len('option dry-run '):] == 'true'
+            self._write('ok')
         else:
             self._write('unsupported')
 
@@ -160,46 +223,56 @@ class Helper(object):
 
         for sha, blossom_key in self._refs.values():
             self._trace(f"Set blossom key of {sha} to {blossom_key} in memory.")
-            self._blossom_keys[sha] = blossom_key
+            self._keys.add(bytes.fromhex(sha), bytes.fromhex(blossom_key))
 
         self._write()
 
     async def _do_push(self, line):
         """
         Handle the push command.
+
+        All refspecs of the batch are collected first, so that the objects of
+        all refs are enumerated and uploaded together.
         """
-        remote_head = None
+        refspecs = []
         while True:
             src, dst = line.split(' ')[1].split(':')
-            if src == '':
-                self._delete(dst)
-            else:
-                await self._push(src, dst)
-                if self._first_push:
-                    if not remote_head or src == git.symbolic_ref('HEAD'):
-                        remote_head = dst
+            refspecs.append((src, dst))
             line = readline()
             if line == '':
-                if self._first_push:
-                    self._first_push = False
-                    err = await self._remote.write_symbolic_ref('HEAD', remote_head)
-                    if err:
-                        self._trace(f'failed to set default branch on remote: {err}', Level.INFO)
                 break
             self._trace(f'< {line}')
+
+        pushes = [(src, dst) for (src, dst) in refspecs if src != '']
+        if pushes:
+            await self._push(pushes)
+        for src, dst in refspecs:
+            if src == '':
+                self._delete(dst)
         self._write()
 
     async def _do_fetch(self, line):
         """
         Handle the fetch command.
         """
+        # Collect the whole batch, so that all wanted refs are fetched in one traversal.
+        wanted = []
         while True:
             _, sha, value = line.split(' ')
-            await self._fetch(sha)
+            wanted.append(sha)
             line = readline()
             if line == '':
                 break
             self._trace(f"< {line}")
+        await self._fetch(wanted)
+        if self._cloning or self._check_connectivity:
+            # Objects were not probed one by one, check them all at once.
+            with metrics.phase('connectivity check'):
+                if not git.histories_exist(wanted, new_only=not self._cloning):
+                    self._fatal('connectivity check failed: fetched objects are incomplete')
+            if self._check_connectivity:
+                # git skips its own check then.
+                self._write('connectivity-ok')
         self._write()
 
     def _delete(self, ref):
@@ -216,76 +289,323 @@ class Helper(object):
         self._pushed.pop(ref, None)  # discard
         self._write('ok %s' % ref)
 
-    async def _push(self, src, dst):
-        """Push local src to remote dst."""
+    async def _push(self, refspecs):
+        """Push local refs to remote refs, given as a list of (src, dst)."""
         if self._remote._remote_pubkey != self._sk.public_key_hex():
-            error("Only the repository owner can push." +\
+            self._fatal("Only the repository owner can push." +\
                 " Push by contributor is not yet supported.")
 
-        force = False
-        if src.startswith('+'):
-            src = src[1:]
-            force = True
+        updates = []
+        for src, dst in refspecs:
+            force = False
+            if src.startswith('+'):
+                src = src[1:]
+                force = True
+            updates.append((src, git.ref_value(src), dst, force))
 
+        # Objects reachable from remote refs and from refs pushed earlier
+        # in this session are already stored.
         present = [sha for (sha, blossom_key) in self._refs.values()]
-        # present.extend([sha for (sha, name) in self._pushed])
-        # Store all referenced git objects in blossom, then update ref on the relays.
+        present.extend(self._pushed.values())
+        # Store all referenced git objects in blossom, then update refs on the relays.
         self._trace(f"Present refs: {', '.join(present)}")
-        objects = git.list_objects(src, present)
-        self._trace(f"{len(objects)} objects to push: {', '.join(objects)}")
-
+        if self._dry_run:
+            await self._plan_push(updates, present)
+            return
         # Initialize progressbar.
-        self._total = len(objects)
-        self._trace('', level=Level.INFO, exact=True)
+        self._total = 0
         self._done = 0
+        self._enumerating = True
+        self._trace('', level=Level.INFO, exact=True)
 
         try:
-            # Upload objects in parallel.
-            tasks = []
-            for sha in reversed(objects):
-                self._trace(f"Adding task put_object({sha}).")
-                tasks.append(asyncio.create_task(self._put_object(sha)))
-                # Create async event for synchornizing sha256 calc of git objects.
-                self._have_blossom_key[sha] = asyncio.Event()
-
-                if len(tasks) < self._concurrency:
-                    continue
-
-                tasks = await self.handle_tasks(tasks)
-
-            while len(tasks):
-                tasks = await self.handle_tasks(tasks)
-
+            with metrics.phase('upload'):
+                await self._upload_objects([sha for (_, sha, _, _) in updates], present)
         except Exception as e:
             if self.verbosity >= Level.DEBUG:
                 raise  # re-raise exception so it prints out a stack trace
             else:
                 self._fatal(f'{str(e)} while storing objects (run with -v for traceback)\n')
 
-        sha = git.ref_value(src)
-        self._trace(f"Upload finished. HEAD is [{sha}].")
+        self._trace("Upload finished.")
 
+        errors = {}
         try:
-            error = await self._remote.write_ref(sha, dst, force)
+            for src, sha, dst, force in updates:
+                errors[dst] = await self._remote.update_ref(sha, dst, force)
+
+            if self._first_push:
+                self._first_push = False
+                self._remote.set_symref('HEAD', self._default_branch(updates))
+
+            await self._remote.publish()
         except Exception:
             if self.verbosity >= Level.DEBUG:
                 raise  # re-raise exception so it prints out a stack trace
             else:
-                self._fatal(f"exception while writing [{dst}]")
+                self._fatal(f"exception while writing [{', '.join(errors)}]")
 
-        if error is None:
-            self._write('ok %s' % dst)
-            self._pushed[dst] = sha
-        else:
-            self._write('error %s %s' % (dst, error))
+        for src, sha, dst, force in updates:
+            error = errors[dst]
+            if error is None:
+                self._write('ok %s' % dst)
+                self._pushed[dst] = sha
+            else:
+                self._write('error %s %s' % (dst, error))
+
+    async def _plan_push(self, updates, present):
+        """
+        Report what pushing updates would upload and publish, without
+        uploading anything: the objects by kind, their size before and (as
+        estimated from a sample) after compression, the objects stored by an
+        earlier push, and the referenced objects missing from the key index.
 
-    async def handle_tasks(self, tasks):
+        The estimate encodes the samples like a push: blobs that may become
+        deltas are sampled apart and encoded against their parent version,
+        and the zstd dictionary of the repo is used, or trained and counted.
+
+        With nostr.dryruncheck, the objects stored by an earlier push are
+        looked up on the blossom servers.
+        """
+        counts = {}  # {kind: [objects, bytes]}
+        # {kind, or 'delta' for blobs that may become deltas: [bytes, candidates, [(sha, name of the base)]]},
+        # with a uniform sample of the objects up to DRY_RUN_SAMPLE_BYTES.
+        samples = {}
+        parent = None  # First parent of the commit listed last, see _upload_objects.
+        pushed = ShaSet(self._hash_len)
+        earlier = []  # Objects with a blossom key in the local index.
+        referenced = bytearray()  # Objects referenced by the pushed ones, not pushed before them.
+        reader = git.ObjectReader()
+        try:
+            async for sha, kind, size, rest in git.stream_objects([sha for _, sha, _, _ in updates], present):
+                binsha = bytes.fromhex(sha)
+                pushed.add(binsha)
+                entry = counts.setdefault(kind, [0, 0])
+                entry[0] += 1
+                entry[1] += size
+                base = None
+                if kind == 'commit':
+                    parent = rest.split(' ', 1)[0] or None
+                elif kind == 'blob' and self._codec.deltas and parent and rest and \
+                        DELTA_MIN_SIZE <= size < DELTA_MAX_SIZE // 2:
+                    base = f'{parent}:{rest}'
+                sample = samples.setdefault(kind if base is None else 'delta', [0, 0, []])
+                sample[0] += size
+                if size <= DRY_RUN_SAMPLE_BYTES:
+                    sample[1] += 1
+                    slot = random.randrange(sample[1])
+                    if len(sample[2]) < DRY_RUN_SAMPLES:
+                        sample[2].append((sha, base))
+                    elif slot < DRY_RUN_SAMPLES:
+                        sample[2][slot] = (sha, base)
+                if self._keys.read(binsha) is not None:
+                    earlier.append(binsha)
+                if kind != 'blob':
+                    obj_kind, contents = reader.read(sha)
+                    for ref, _ in git.parse_references(obj_kind, contents, self._hash_len):
+                        entry[1] += 32  # Its blossom key is part of the payload.
+                        sample[0] += 32
+                        ref = bytes.fromhex(ref)
+                        if ref not in pushed:
+                            referenced += ref
+        finally:
+            reader.close()
+
+        missing = 0
+        for off in range(0, len(referenced), self._hash_len):
+            ref = bytes(referenced[off:off + self._hash_len])
+            if ref not in pushed and self._keys.read(ref) is None:
+                missing += 1
+        del referenced
+
+        estimate = 0
+        if self._codec.name == 'zstd-dict':
+            estimate += await self._prepare_dictionary(
+                [sha for kind in ('commit', 'tree') for sha, _ in samples.get(kind, [0, 0, []])[2]],
+                store=False)
+
+        # The compression ratio of each kind is measured on its sample, read
+        # one object at a time until DRY_RUN_SAMPLE_BYTES were encoded. Kinds
+        # with only larger objects are counted as stored uncompressed.
+        reader = git.ObjectReader()
+        try:
+            for kind, (size, _, sample) in samples.items():
+                random.shuffle(sample)
+                raw = stored = 0
+                for sha, base in sample:
+                    if raw >= DRY_RUN_SAMPLE_BYTES:
+                        break
+                    raw, stored = self._plan_encode(reader, sha, base, raw, stored)
+                estimate += size * stored / raw if raw else size
+        finally:
+            reader.close()
+
+
+        on_servers = None
+        if earlier and git.get_config_value("nostr.dryruncheck") in ("true", "yes", "on", "1"):
+            async def check(sha):
+                async with self._semaphore:
+                    return await self._blossom.is_stored(self._keys.read(sha).hex())
+            on_servers = sum(await asyncio.gather(*(check(sha) for sha in earlier)))
+
+        errors = {dst: self._remote.check_ref(sha, dst, force) for _, sha, dst, force in updates}
+        events = self._remote.count_events([dst for dst, error in errors.items() if error is None])
+
+        def human_size(n):
+            return f'{n / (1 << 20):.1f} MiB' if n >= 1 << 20 else f'{n / 1024:.1f} KiB'
+
+        total = sum(n for n, _ in counts.values())
+        kinds = ', '.join(f'{counts[kind][0]} {kind}' + ('s' if counts[kind][0] != 1 else '')
+                          for kind in ('commit', 'tree', 'blob', 'tag') if kind in counts)
+        report = [f'Dry run: {total} objects to upload' + (f' ({kinds})' if kinds else '')]
+        report.append(f'  {human_size(sum(b for _, b in counts.values()))}, '
+                      f'about {human_size(estimate)} after {self._codec.name} compression' +
+                      (' and deltas' if self._codec.deltas else ''))
+        if earlier:
+            report.append(f'  {len(earlier)} objects were uploaded by an earlier push' +
+                          (f', {on_servers} of them are on the blossom servers' if on_servers is not None else ''))
+        if missing:
+            report.append(f"  {missing} referenced objects have no blossom key,"
+                          f" run 'git-remote-blossom index {self._remote_name}'")
+        report.append(f'  {events} state events to publish on {self._remote.relay_count()} relays')
+        self._trace('\n'.join(report) + '\n', level=Level.INFO, exact=True)
+
+        for _, sha, dst, force in updates:
+            if errors[dst] is None:
+                self._write('ok %s' % dst)
+            else:
+                self._write('error %s %s' % (dst, errors[dst]))
+
+    def _plan_encode(self, reader, sha, base, raw, stored):
+        """
+        Encode the object sha like a push would, as a delta against the object
+        named base if that is smaller, and add its sizes to raw and stored.
+        """
+        obj_kind, contents = reader.read(sha)
+        data = git.encode_object_raw(obj_kind, contents)
+        # Keys of referenced objects are random, and do not compress.
+        data += os.urandom(32 * len(git.parse_references(obj_kind, contents, self._hash_len)))
+        payload = self._codec.encode(data, obj_kind)
+        base = git.read_named_object(base) if base else None
+        if base is not None and base[1] == 'blob' and base[0] != sha:
+            delta = self._codec.encode_delta(data, git.encode_object_raw('blob', base[2]), bytes(32), 1)
+            if len(delta) <= len(data) * DELTA_RATIO:
+                payload = delta
+        return raw + len(data), stored + len(payload)
+
+    def _default_branch(self, updates):
+        """
+        Return the remote ref that becomes HEAD on the first push: the one
+        pushed from the local HEAD branch, or else the first pushed ref.
+        """
+        try:
+            local_head = git.symbolic_ref_value('HEAD')
+        except Exception:
+            local_head = None
+
+        for src, sha, dst, force in updates:
+            if src in (local_head, 'HEAD'):
+                return dst
+        return updates[0][2]
+
+    async def _upload_objects(self, refs, present):
+        """
+        Upload the objects reachable from refs and not from present, while
+        git enumerates them.
+
+        Blobs reference nothing, so they are uploaded as soon as they are
+        listed, in the order of the scheduler among the next SCHEDULER_WINDOW
+        blobs. Commits, trees and tags are kept (as binary ids) until the
+        enumeration is complete and uploaded then, oldest first, tags last.
+        So are blobs that may become deltas against older versions.
+        """
+        hash_len = self._hash_len
+        deferred = bytearray()  # Commits, trees and delta candidates, newest first.
+        tags = []
+        blobs = self._scheduler('push queue')
+        parent = None  # First parent of the commit listed last.
+        async for sha, kind, size, rest in git.stream_objects(refs, present):
+            self._total += 1
+            binsha = bytes.fromhex(sha)
+            # Objects referencing sha wait for its upload, see _dependency_key.
+            self._pushing.add(binsha)
+            if kind == 'commit':
+                parent = rest.split(' ', 1)[0] or None
+                deferred += binsha
+            elif kind == 'blob' and self._codec.deltas and parent and rest and \
+                    DELTA_MIN_SIZE <= size < DELTA_MAX_SIZE // 2:
+                # May be stored as a delta against the version at the same
+                # path in the parent, which is pushed before it, if at all.
+                self._delta_bases[binsha] = f'{parent}:{rest}'
+                deferred += binsha
+            elif kind == 'blob':
+                blobs.push(binsha, kind, size)
+                await self._start_uploads(blobs, SCHEDULER_WINDOW)
+            elif kind == 'tag':
+                tags.append(binsha)
+            else:
+                deferred += binsha
+        await self._start_uploads(blobs, 0)
+        self._enumerating = False
+        metrics.count('objects_pushed', self._total)
+
+        if self._codec.name == 'zstd-dict':
+            await self._prepare_dictionary(
+                [deferred[off:off + hash_len].hex() for off in range(0, len(deferred), hash_len)
+                 if bytes(deferred[off:off + hash_len]) not in self._delta_bases])
+
+        for off in range(len(deferred) - hash_len, -1, -hash_len):
+            binsha = bytes(deferred[off:off + hash_len])
+            if binsha in self._started:
+                continue  # Already started by an object referencing it.
+            self._start_upload(binsha)
+            if len(self._uploads) >= self._concurrency:
+                await self.handle_tasks()
+        del deferred
+
+        for binsha in reversed(tags):
+            if binsha not in self._started:
+                self._start_upload(binsha)
+            if len(self._uploads) >= self._concurrency:
+                await self.handle_tasks()
+
+        while self._uploads:
+            await self.handle_tasks()
+        if self._total:
+            self._trace('\rWriting objects: 100% ({}/{}), done.\n'.format(self._done, self._total),
+                        level=Level.INFO, exact=True)
+
+    async def _start_uploads(self, queue, limit):
+        """
+        Start uploads from queue while there are free slots, and wait for
+        uploads to finish while queue holds more than limit objects.
+        """
+        while len(queue):
+            if any(task.done() for task in self._uploads):
+                await self.handle_tasks()
+            if len(self._uploads) < self._concurrency:
+                self._start_upload(queue.pop())
+            elif len(queue) > limit:
+                await self.handle_tasks()
+            else:
+                break
+
+    def _start_upload(self, binsha):
+        self._trace(f"Adding task put_object({binsha.hex()}).")
+        self._started.add(binsha)
+        self._key_waiters[binsha] = asyncio.get_running_loop().create_future()
+        self._uploads.add(asyncio.create_task(self._put_object(binsha.hex())))
+
+    async def handle_tasks(self):
+        tasks = self._uploads
         self._trace(f"Waiting for {len(tasks)} tasks.")
         tasks_done, pending =\
             await asyncio.wait(
                 tasks, timeout=15, return_when=asyncio.FIRST_COMPLETED)
         self._trace(f"Done: {len(tasks_done)} tasks.")
         self._done += len(tasks_done)
+        # Tasks started meanwhile for referenced objects are kept.
+        self._uploads = tasks - tasks_done
 
         exc = None
         # Raise any errors that occurred in async tasks.
@@ -296,20 +616,18 @@ class Helper(object):
                 self._trace(f"{t} had exception {str(e)}")
 
         if exc:
-            for p in pending:
+            for p in self._uploads:
                 p.cancel()
             # We can raise now that all (pending, done) exceptions were retrieved.
             raise exc
 
-        pct = int(float(self._done) / self._total * 100)
-        message = '\rWriting objects: {:3.0f}% ({}/{})'.format(pct, self._done, self._total)
-        if self._done == self._total:
-            message = '%s, done.\n' % message
-            self._trace(message, level=Level.INFO, exact=True)
-            return []
-
+        if self._enumerating:
+            message = '\rWriting objects: {}/{}, counting...'.format(self._done, self._total)
+        else:
+            pct = int(float(self._done) / self._total * 100)
+            message = '\rWriting objects: {:3.0f}% ({}/{})'.format(pct, self._done, self._total)
         self._trace(message, level=Level.INFO, exact=True)
-        return list(pending)
+        self._trace(f"uploads in flight: {len(self._uploads)}")
 
     def _ref_name_from_path(self, path):
         """
@@ -320,6 +638,7 @@ class Helper(object):
         return path[len(prefix):]
 
     async def _blossom_store(self, data, sha256):
+        from monstr.event.event import Event
         auth_event = Event(
             kind=24242,
             content=f"Upload {sha256.hex()}",
@@ -334,133 +653,478 @@ class Helper(object):
         json_auth = json.dumps(auth_event.data(), separators=(',',':'))
         b64_auth = base64.b64encode(json_auth.encode()).decode()
 
-        # Upload object to blossom.
-        async with aiohttp.ClientSession() as sess:
-            async with sess.put(
-                    f"{self._blossom_server}/upload",
-                    data=data,
-                    headers={
-                        "Authorization": f"Nostr {b64_auth}",
-                        "Content-Type": "application/octet-stream"
-                    }) as resp:
-
-                if resp.status != 200:
-                    txt = await resp.text()
-                    raise Exception(txt)
-
-                await resp.text()
+        # Upload object to the blossom servers.
+        await self._blossom.upload(data, {
+            "Authorization": f"Nostr {b64_auth}",
+            "Content-Type": "application/octet-stream"
+        })
 
     async def _put_object(self, sha):
         self._trace(f"_put_object({sha})")
-        async with self._semaphore:
-            return await self.__put_object(sha)
-
-    async def __put_object(self, sha):
-        """Upload an object to blossom."""
         if self._objectformat == "sha256":
             raise Exception("WE_ARE_HERE: re-add sha256 support")
 
-        self._trace(f"__put_object({sha})")
+        kind, contents = git.read_object(sha)
+        data = git.encode_object_raw(kind, contents)
+        # Waiting for referenced objects does not hold an upload slot.
+        base = await self._delta_base(bytes.fromhex(sha), len(data))
+        for dep, _ in git.parse_references(kind, contents, self._hash_len):
+            data += await self._dependency_key(bytes.fromhex(dep))
 
-        data = git.encode_object(sha)
-        for dep in git.referenced_objects(sha):
-            # Check if blossom key of referenced git object is on disk.
-            blossom_key = self._remote._read_blossom_key(dep)
-            if blossom_key:
-                data += blossom_key
-                continue
+        async with self._semaphore:
+            metrics.gauge('slots', 1)
+            try:
+                return await self.__put_object(sha, kind, data, base)
+            finally:
+                metrics.gauge('slots', -1)
 
-            await self._have_blossom_key[dep].wait()
-            blossom_key = self._remote._read_blossom_key(dep)
-            data += blossom_key
+    async def _delta_base(self, sha, size):
+        """
+        Return (blossom key, encoded object, depth) for storing the blob sha
+        as a delta against its version in the parent commit, with depth the
+        depth of the delta, or None if it is stored whole.
+        """
+        name = self._delta_bases.get(sha)
+        if name is None:
+            return None
+        base = git.read_named_object(name)
+        if base is None or base[1] != 'blob':
+            return None
+        base_sha, kind, contents = base
+        base_sha = bytes.fromhex(base_sha)
+        if base_sha == sha:
+            return None  # Same content as in the parent, not a change.
+        blossom_key = self._keys.read(base_sha)
+        if blossom_key is None:
+            # A base that is a delta candidate itself may wait for this blob
+            # (content reverted to an earlier version), only whole ones are
+            # waited for.
+            if base_sha not in self._pushing or base_sha in self._delta_bases:
+                return None
+            blossom_key = await self._dependency_key(base_sha)
+        depth = self._depths.get(base_sha)
+        if depth is None:
+            depth = self._keys.depth(base_sha)
+        data = git.encode_object_raw(kind, contents)
+        if depth is None or depth >= DELTA_MAX_DEPTH or size + len(data) >= DELTA_MAX_SIZE:
+            return None
+        return blossom_key, data, depth + 1
+
+    async def __put_object(self, sha, kind, data, base=None):
+        """
+        Upload an object, encoded and followed by the keys of the objects it
+        references, or as a delta against base, see _delta_base.
+        """
+        self._trace(f"__put_object({sha})")
 
-        data = zlib.compress(data)
-        #NOTE: We can compress data with zlib for storage,
+        metrics.count('payload_bytes_raw', len(data))
+        depth = 0
+        with metrics.timer('compress'):
+            payload = None
+            if base is not None:
+                base_key, base_data, base_depth = base
+                payload = self._codec.encode_delta(data, base_data, base_key, base_depth)
+                if len(payload) > len(data) * DELTA_RATIO:
+                    payload = None
+                else:
+                    depth = base_depth
+                    metrics.count('deltas')
+            data = payload if payload is not None else self._codec.encode(data, kind)
+        metrics.count('payload_bytes_stored', len(data))
+        #NOTE: We can compress data for storage,
         # because the blossom key (sha256) is not based
         # on the uncompressed data. If it was a single sha256
         # hash that is both the hash of the data and the
         # commit id, we would need to store it plaintext.
 
         # Blossom key of current git object
-        blossom_key = hashlib.sha256(data).digest()
-        self._remote._write_blossom_key(sha, blossom_key)
-        self._have_blossom_key[sha].set()
+        with metrics.timer('hash'):
+            blossom_key = hashlib.sha256(data).digest()
+        binsha = bytes.fromhex(sha)
+        self._keys.write(binsha, blossom_key, depth)
+        if self._codec.deltas:
+            self._depths[binsha] = depth
+            self._delta_bases.pop(binsha, None)
+        waiter = self._key_waiters.pop(binsha, None)
+        if waiter is not None:
+            waiter.set_result(blossom_key)
 
         await self._blossom_store(data, blossom_key)
         self._trace(f'Stored {sha} on blossom server.')
 
-    async def _download(self, sha):
+    async def _prepare_dictionary(self, objects, store=True):
+        """
+        Use the compression dictionary of the repo, or train one on objects,
+        the commits and trees about to be pushed, and store it on blossom.
+
+        Without store, for dry runs, a trained dictionary is only used here.
+        Return the size of the dictionary to upload, 0 if there is none.
+        """
+        key = self._remote.get_dictionary()
+        if key:
+            key = bytes.fromhex(key)
+            await self._load_dictionary(key)
+            self._codec.use_dictionary(key)
+            return 0
+
+        candidates = objects
+        step = max(1, len(candidates) // DICT_SAMPLES)
+        samples = [git.encode_object_raw(kind, contents)
+                   for kind, contents in git.read_objects(candidates[::step])]
+        dictionary = self._codec.train(samples)
+        if dictionary is None:
+            self._trace(f"Too few commits and trees ({len(samples)}) to train a compression dictionary.")
+            return 0
+
+        key = hashlib.sha256(dictionary).digest()
+        if store:
+            await self._blossom_store(dictionary, key)
+        self._codec.add_dictionary(key, dictionary)
+        self._codec.use_dictionary(key)
+        if store:
+            self._remote.set_dictionary(key.hex())
+            self._trace(f"Stored compression dictionary {key.hex()} ({len(dictionary)} bytes).")
+        return len(dictionary)
+
+    async def _load_dictionary(self, key):
+        """Download the compression dictionary stored under binary blossom key, once."""
+        if self._codec.has_dictionary(key):
+            return
+        if key not in self._dictionaries:
+            self._dictionaries[key] = asyncio.ensure_future(self.__load_dictionary(key))
+        await self._dictionaries[key]
+
+    async def __load_dictionary(self, key):
+        data = await self._blossom.download(key.hex())
+        self._codec.add_dictionary(key, data)
+
+    async def _dependency_key(self, sha):
+        """
+        Return the blossom key of a referenced object, waiting for it if the
+        object is being pushed right now.
+        """
+        if sha in self._pushing:
+            if sha not in self._started:
+                # Listed after the object referencing it, start it right away.
+                self._start_upload(sha)
+            waiter = self._key_waiters.get(sha)
+            if waiter is not None:
+                return await waiter
+            # Otherwise its key is in the index already.
+
+        blossom_key = self._keys.read(sha)
+        if blossom_key is None:
+            raise Exception(f"blossom key of {sha.hex()} is not in the local key index,"
+                            f" run 'git-remote-blossom index {self._remote_name}'")
+        return blossom_key
+
+    def _start_download(self, sha, kind, blossom_key):
+        """Return a future of _download, run here or by a fetch worker."""
+        if self._fetch_workers > 1:
+            if self._workers is None:
+                # Imported here, multiprocessing is only needed with workers.
+                from git_remote_blossom.fetchworkers import FetchWorkers
+                self._workers = FetchWorkers(self._fetch_workers, self._remote_name, self._path,
+                                             self._verbosity, self._concurrency)
+            return self._workers.download(sha, kind, blossom_key)
+        return asyncio.create_task(self._download(sha, kind, blossom_key))
+
+    async def _download(self, sha, kind, blossom_key):
         async with self._semaphore:
-            return await self.__download(sha)
+            metrics.gauge('slots', 1)
+            metrics.gauge(f'{kind}s in flight', 1)
+            try:
+                return await self.__download(sha, blossom_key)
+            finally:
+                metrics.gauge('slots', -1)
+                metrics.gauge(f'{kind}s in flight', -1)
+
+    async def __download(self, sha, blossom_key):
+        """
+        Download binary sha object from blossom.
+
+        Return sha and the list of (sha, kind, blossom_key) of the objects it references.
+        """
+        if blossom_key is None:
+            raise Exception(f"blossom key of {sha.hex()} is unknown")
+        obj_type, obj_data, blossom_keys = self._split_payload(await self._load(blossom_key))
+
+        with metrics.timer('object write'):
+            computed_sha = git.decode_object_raw(obj_type, obj_data)
+        metrics.count('objects_fetched')
 
-    async def __download(self, sha):
-        """Download sha object from blossom."""
-        blossom_key = self._blossom_keys[sha]
-        assert blossom_key
+        if computed_sha != sha.hex():
+            raise Exception(f"hash mismatch {computed_sha} != {sha.hex()}")
 
-        self._trace(f"fetching {blossom_key}")
-        async with aiohttp.ClientSession() as sess:
-            async with sess.get(f"{self._blossom_server}/{blossom_key}") as resp:
-                if resp.status != 200:
-                    txt = await resp.text()
-                    #WE_ARE_HERE: error handling
-                    raise Exception(txt)
+        referenced = []
+        for referenced_sha, kind in git.parse_references(obj_type, obj_data, self._hash_len):
+            referenced.append((bytes.fromhex(referenced_sha), kind, blossom_keys[:32]))
+            blossom_keys = blossom_keys[32:]
+        assert len(blossom_keys) == 0
 
-                data = await resp.read()
+        return sha, referenced
 
+    async def _decode_payload(self, data):
+        """
+        Return (kind, contents, blossom keys) of a downloaded payload: the
+        object, and the keys of the objects it references.
+        """
         assert len(data) > 0, data
+        return self._split_payload(await self._decompress(data))
 
-        decompressed = zlib.decompress(data)
+    def _split_payload(self, decompressed):
         # Decompressed data starts with the git object in the classic git format.
         # Referenced git objects' blossom hashes are read from the end.
         header, tail = decompressed.split(b"\x00", 1)
         obj_type, obj_len = header.split()
         obj_len = int(obj_len)
-        obj_data = tail[:obj_len]
-        blossom_keys = tail[obj_len:]
+        return obj_type.decode('utf8'), tail[:obj_len], tail[obj_len:]
+
+    async def _decompress(self, payload, depth=0):
+        """
+        Return the data stored in payload. Deltas are applied to their bases,
+        loaded like the objects themselves, depth the number of deltas above.
+        """
+        base_key = self._codec.delta_base(payload)
+        if base_key is None:
+            dictionary = self._codec.dictionary_key(payload)
+            if dictionary is not None:
+                await self._load_dictionary(dictionary)
+            with metrics.timer('decompress'):
+                return self._codec.decode(payload)
+        if depth >= DELTA_MAX_DEPTH:
+            raise Exception(f"delta chain of {base_key.hex()} is longer than {DELTA_MAX_DEPTH}")
+        base = await self._load(base_key, depth + 1)
+        with metrics.timer('decompress'):
+            return self._codec.decode(payload, base)
+
+    async def _load(self, blossom_key, depth=0):
+        """
+        Return the decompressed data stored under binary blossom key.
 
-        computed_sha = git.decode_object_raw(obj_type, obj_data)
+        Objects and delta bases share this, so that a key wanted as both, or
+        by several deltas at the same time, is downloaded and decompressed
+        once. Blobs that may be delta bases stay in a cache of recent ones.
+        """
+        data = self._bases.get(blossom_key)
+        if data is not None:
+            self._bases.move_to_end(blossom_key)
+            metrics.count('delta_base_hits')
+            return data
+        if blossom_key not in self._loads:
+            load = asyncio.ensure_future(self.__load(blossom_key, depth))
+            load.add_done_callback(lambda _: self._loads.pop(blossom_key, None))
+            self._loads[blossom_key] = load
+        return await asyncio.shield(self._loads[blossom_key])
+
+    async def __load(self, blossom_key, depth):
+        self._trace(f"fetching {blossom_key.hex()}")
+        payload = await self._blossom.download(blossom_key.hex())
+        data = await self._decompress(payload, depth)
+        if data.startswith(b'blob ') and DELTA_MIN_SIZE <= len(data) < DELTA_MAX_SIZE // 2:
+            self._bases[blossom_key] = data
+            self._bases_size += len(data)
+            while self._bases_size > DELTA_CACHE_SIZE:
+                _, evicted = self._bases.popitem(last=False)
+                self._bases_size -= len(evicted)
+        return data
+
+    async def index(self):
+        """
+        Rebuild the local key index from the remote.
+
+        Walks the remote from the keys of its refs. Blobs reference nothing,
+        so only commits, trees and tags are downloaded, for the keys of the
+        objects they reference. Objects whose references are in the index
+        already are not downloaded again: those walked by an earlier run, and
+        local objects pushed from here. Downloaded objects are verified
+        against their id and against the local object.
+        """
+        _, refs = await self._remote.get_refs(for_push=False)
+        self._indexed = self._downloaded = 0
+        queue = self._scheduler('index queue')
+        for sha, blossom_key in refs.values():
+            binsha = bytes.fromhex(sha)
+            self._index_key(binsha, bytes.fromhex(blossom_key))
+            queue.push((binsha, 'commit'), 'commit')
+
+        self._walked = self._keys.walked(self._hash_len)
+        self._reader = git.ObjectReader()
+        visited = ShaSet(self._hash_len)
+        walked = 0
+        tasks = set()
+        try:
+            while len(queue) or tasks:
+                if len(queue) and len(tasks) < self._concurrency:
+                    sha, kind = queue.pop()
+                    if sha in visited:
+                        continue
+                    visited.add(sha)
+                    tasks.add(asyncio.create_task(self._index_object(sha)))
+                    continue
 
-        if computed_sha != sha:
-            raise Exception(f"hash mismatch {computed_sha} != {sha}")
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    walked += 1
+                    for sha, kind in task.result():
+                        if kind != 'blob' and sha not in visited:
+                            queue.push((sha, kind), kind)
+                message = '\rIndexing objects: {} walked, {} downloaded, {} keys'.format(
+                    walked, self._downloaded, self._indexed)
+                self._trace(message, level=Level.INFO, exact=True)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._reader.close()
+            self._keys.close()
+
+        self._trace('\rIndexing objects: {} walked, {} downloaded, {} keys, done.\n'.format(
+            walked, self._downloaded, self._indexed), level=Level.INFO, exact=True)
+
+    async def snapshot(self):
+        """
+        Store a pack of everything reachable from the remote refs on blossom,
+        and name it in the state event, for clones to start from.
+        """
+        if self._remote._remote_pubkey != self._sk.public_key_hex():
+            self._fatal("Only the repository owner can publish a snapshot.")
+        # Read for push: the state event is published again below.
+        _, refs = await self._remote.get_refs(for_push=True)
+        shas = sorted(set(sha for sha, _ in refs.values()))
+        if not shas:
+            self._fatal("The remote has no refs yet, push first.")
+        if not git.histories_exist(shas):
+            self._fatal("The remote refs are not all present locally, fetch first.")
+
+        self._trace('Packing objects...', level=Level.INFO)
+        # The pack goes through a file, it may not fit in memory.
+        with tempfile.NamedTemporaryFile(dir=self._git_dir, prefix='snapshot-', suffix='.pack') as pack:
+            with metrics.phase('pack'):
+                git.pack_objects(shas, pack)
+            pack.seek(0)
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: pack.read(1 << 20), b''):
+                digest.update(chunk)
+            key = digest.digest()
+            self._trace(f'Uploading snapshot of {len(shas)} commits, {pack.tell() / (1 << 20):.1f} MiB...',
+                        level=Level.INFO)
+            with metrics.phase('upload'):
+                await self._blossom_store(pack.name, key)
+        self._remote.set_snapshot(key.hex(), len(shas))
+        await self._remote.publish()
+        self._trace(f'Published snapshot {key.hex()}.', level=Level.INFO)
+
+    async def _fetch_snapshot(self):
+        """
+        Download the snapshot pack of the remote into the local repository.
 
-        for referenced_sha in git.referenced_objects(sha):
-            self._blossom_keys[referenced_sha] = blossom_keys[:32].hex()
-            blossom_keys = blossom_keys[32:]
-        assert len(blossom_keys) == 0
+        Return whether it was stored. Without it, everything is fetched object
+        by object, so failures are not fatal.
+        """
+        snapshot = self._remote.get_snapshot()
+        if snapshot is None:
+            return False
+        key, count = snapshot
+        self._trace(f"Receiving snapshot of {count} commits...", level=Level.INFO)
+        path = os.path.join(self._git_dir, 'snapshot.pack')
+        try:
+            with metrics.phase('snapshot'):
+                size = await self._blossom.download(key, path)
+                git.index_pack(path)
+        except Exception as e:
+            self._trace(f"snapshot failed, fetching objects one by one: {e}", level=Level.INFO)
+            return False
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+        self._trace(f"Stored snapshot {key} ({size / (1 << 20):.1f} MiB).")
+        return True
+
+    def _index_key(self, sha, blossom_key):
+        if self._keys.read(sha) != blossom_key:
+            self._keys.write(sha, blossom_key, UNKNOWN_DEPTH)
+            self._indexed += 1
+
+    async def _index_object(self, sha):
+        """
+        Put the keys of the objects referenced by sha into the index.
 
-        return sha
+        Return the list of (sha, kind) of the referenced objects.
+        """
+        local = self._reader.read(sha.hex())
+        if local is not None:
+            referenced = [(bytes.fromhex(ref), kind)
+                          for ref, kind in git.parse_references(*local, self._hash_len)]
+            if sha in self._walked or all(self._keys.read(ref) for ref, _ in referenced):
+                return referenced
+
+        blossom_key = self._keys.read(sha)
+        if blossom_key is None:
+            # Referenced by an object walked by an earlier run, whose keys
+            # have since been removed from the index: it cannot be downloaded.
+            self._trace(f"{sha.hex()} is not indexed, skipped.")
+            return []
+        async with self._semaphore:
+            data = await self._blossom.download(blossom_key.hex())
+        self._downloaded += 1
+        obj_type, obj_data, blossom_keys = await self._decode_payload(data)
+        if git.hash_object(obj_type, obj_data, self._hash_len) != sha:
+            raise Exception(f"hash mismatch of {sha.hex()} stored under {blossom_key.hex()}")
+        if local is not None and local != (obj_type, obj_data):
+            raise Exception(f"{sha.hex()} on the remote differs from the local object")
+
+        referenced = []
+        for ref, kind in git.parse_references(obj_type, obj_data, self._hash_len):
+            ref = bytes.fromhex(ref)
+            self._index_key(ref, blossom_keys[:32])
+            blossom_keys = blossom_keys[32:]
+            referenced.append((ref, kind))
+        self._keys.mark_walked(sha)
+        return referenced
 
-    async def _fetch(self, sha):
+    async def _fetch(self, shas):
         """
-        Recursively fetch the given object and the objects it references.
+        Recursively fetch the given objects and the objects they reference.
         """
-        # have multiple threads downloading in parallel
-        queue = asyncio.Queue()
-        await queue.put(sha)
+        # Object ids are kept binary, and keys of the frontier live in
+        # self._keys only until their download starts.
+        # A clone starts with an empty object store, nothing to probe, unless
+        # the snapshot filled it.
+        probe = not self._cloning
+        if self._cloning and await self._fetch_snapshot():
+            probe = True
+
+        queue = self._scheduler('fetch queue')
+        for sha in shas:
+            queue.push((bytes.fromhex(sha), 'commit'), 'commit')
         pending = set()
-        downloaded = set()
+        seen = ShaSet(self._hash_len)  # Downloaded or present locally.
         self._trace('', level=Level.INFO, exact=True)  # for showing progress
         done_cnt = total = 0
         tasks = set()
-
-        while queue.qsize() or pending:
-            if queue.qsize():
-                # if possible, queue up download
-                sha = await queue.get()
-                if sha in downloaded or sha in pending:
+        # Every fetch worker runs as many downloads as the helper alone.
+        limit = self._concurrency * self._fetch_workers
+
+        while len(queue) or pending:
+            # Downloads are started only when there is room for them, so
+            # that the scheduler decides what comes next.
+            if len(queue) and len(tasks) < limit:
+                sha, kind = queue.pop()
+                if sha in pending or sha in seen:
                     continue
-                if git.object_exists(sha):
-                    if not git.history_exists(sha):
+                if probe and git.object_exists(sha.hex()):
+                    seen.add(sha)
+                    self._keys.pop(sha)
+                    if not git.history_exists(sha.hex()):
                         # Previous fetch was aborted beforehand
                         # or this is the first blob object in repo.
-                        for referenced in git.referenced_objects(sha):
-                            #TODO: Prioritize commit objects for better concurrency
-                            await queue.put(referenced)
+                        obj_kind, contents = git.read_object(sha.hex())
+                        for referenced, ref_kind in git.parse_references(obj_kind, contents, self._hash_len):
+                            queue.push((bytes.fromhex(referenced), ref_kind), ref_kind)
                 else:
-                    self._trace(f"GET {sha} ")
+                    self._trace(f"GET {sha.hex()} ")
                     pending.add(sha)
-                    tasks.add(asyncio.create_task(self._download(sha)))
+                    tasks.add(self._start_download(sha, kind, self._keys.pop(sha)))
             else:
                 # Download complete.
                 done, pending_tasks = await asyncio.wait(\
@@ -469,22 +1133,25 @@ class Helper(object):
                     if done_task.exception():
                         raise done_task.exception()
 
-                    res = done_task.result()
-                    # self._trace(f"Downloaded {res}")
+                    res, referenced = done_task.result()
+                    # self._trace(f"Downloaded {res.hex()}")
                     pending.remove(res)
-                    downloaded.add(res)
-                    for sha in git.referenced_objects(res):
-                        await queue.put(sha)
+                    seen.add(res)
+                    done_cnt += 1
+                    for sha, kind, blossom_key in referenced:
+                        if sha in pending or sha in seen:
+                            continue
+                        self._keys.add(sha, blossom_key)
+                        queue.push((sha, kind), kind)
                     # show progress
-                    done_cnt = len(downloaded)
-                    total = done_cnt + len(pending)
+                    total = done_cnt + len(pending) + len(queue)
                     pct = int(float(done_cnt) / total * 100)
                     message = '\rReceiving objects: {:3.0f}% ({}/{})'.format(pct, done_cnt, total)
                     self._trace(message, level=Level.INFO, exact=True)
 
                 tasks = pending_tasks
+                self._trace(f"fetch queue: {len(queue)}, in flight: {len(tasks)}")
 
         if total:
-            self._trace('\rReceiving objects: 100% ({}/{}), done.\n'.format(done_cnt, total),
+            self._trace('\rReceiving objects: 100% ({}/{}), done.\n'.format(done_cnt, done_cnt),
                         level=Level.INFO, exact=True)
-
@@ -0,0 +1,162 @@
+import os
+
+from git_remote_blossom.constants import KEY_MEMORY_LIMIT
+
+
+# Depth of objects whose keys were learned from the remote, which might be
+# stored as deltas.
+UNKNOWN_DEPTH = 0xff
+
+
+class ShaSet(object):
+    """
+    A set of binary object ids packed into a single bytearray.
+
+    Uses open addressing with linear probing. Object ids are uniformly
+    distributed, so their leading bytes serve as the hash. This takes about
+    a third of the memory of a set of bytes objects.
+    """
+
+    def __init__(self, width=20, capacity=1 << 12):
+        self._width = width
+        self._empty = bytes(width)
+        self._slots = capacity
+        self._table = bytearray(capacity * width)
+        self._used = 0
+
+    def _find(self, sha):
+        """Return (slot, found) for sha."""
+        w = self._width
+        mask = self._slots - 1
+        i = int.from_bytes(sha[:8], 'big') & mask
+        while True:
+            entry = self._table[i * w:(i + 1) * w]
+            if entry == sha:
+                return i, True
+            if entry == self._empty:
+                return i, False
+            i = (i + 1) & mask
+
+    def _grow(self):
+        old, w = self._table, self._width
+        self._slots *= 2
+        self._table = bytearray(self._slots * w)
+        self._used = 0
+        for off in range(0, len(old), w):
+            entry = bytes(old[off:off + w])
+            if entry != self._empty:
+                self.add(entry)
+
+    def add(self, sha):
+        i, found = self._find(sha)
+        if found:
+            return
+        self._table[i * self._width:(i + 1) * self._width] = sha
+        self._used += 1
+        if self._used * 3 > self._slots * 2:
+            self._grow()
+
+    def __contains__(self, sha):
+        return self._find(sha)[1]
+
+    def __len__(self):
+        return self._used
+
+
+class KeyIndex(object):
+    """
+    Mapping of binary git object ids to binary blossom keys.
+
+    The persistent index lives in $GIT_DIR/blossom/<xx>/<rest>, one file per
+    object, holding the key and, for deltas, the depth of their delta chain.
+    Keys that are only needed for a while (e.g. the frontier of a
+    fetch) are kept in memory, and spilled to disk when there are more than
+    `limit` of them.
+    """
+
+    def __init__(self, git_dir, limit=KEY_MEMORY_LIMIT):
+        self._git_dir = git_dir
+        self._limit = limit
+        self._memory = {}
+        self._walked = None
+
+    def _path(self, sha):
+        sha = sha.hex()
+        return os.path.join(self._git_dir, "blossom", sha[:2], sha[2:])
+
+    def _read(self, sha):
+        path = self._path(sha)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def read(self, sha):
+        """Return the key of sha from the on-disk index, or None."""
+        data = self._read(sha)
+        return data[:32] if data is not None else None
+
+    def depth(self, sha):
+        """Return the delta chain depth of sha from the on-disk index, or None if unknown."""
+        data = self._read(sha)
+        if data is None or len(data) > 32 and data[32] == UNKNOWN_DEPTH:
+            return None
+        return data[32] if len(data) > 32 else 0
+
+    def write(self, sha, key, depth=0):
+        """Store the key of sha in the on-disk index."""
+        path = self._path(sha)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(key + bytes([depth]) if depth else key)
+        os.rename(path + ".tmp", path)
+
+    def add(self, sha, key):
+        """Remember the key of sha in memory."""
+        self._memory[sha] = key
+        if len(self._memory) > self._limit:
+            self._spill()
+
+    def _spill(self):
+        for sha, key in self._memory.items():
+            self.write(sha, key, UNKNOWN_DEPTH)
+        self._memory = {}
+
+    def pop(self, sha):
+        """Return the key of sha and forget it from memory."""
+        key = self._memory.pop(sha, None)
+        if key is None:
+            key = self.read(sha)
+        return key
+
+    def __len__(self):
+        return len(self._memory)
+
+    def _walked_path(self):
+        return os.path.join(self._git_dir, "blossom", "walked")
+
+    def walked(self, width=20):
+        """
+        Return the set of objects whose references have their keys in the
+        on-disk index, as recorded by mark_walked.
+        """
+        walked = ShaSet(width)
+        if os.path.exists(self._walked_path()):
+            with open(self._walked_path(), "rb") as f:
+                data = f.read()
+            # A record cut short by an interrupted run is ignored.
+            for off in range(0, len(data) - len(data) % width, width):
+                walked.add(data[off:off + width])
+        return walked
+
+    def mark_walked(self, sha):
+        """Record that the keys of the objects referenced by sha are in the index."""
+        if self._walked is None:
+            os.makedirs(os.path.dirname(self._walked_path()), exist_ok=True)
+            self._walked = open(self._walked_path(), "ab")
+        self._walked.write(sha)
+
+    def close(self):
+        if self._walked is not None:
+            self._walked.close()
+            self._walked = None
@@ -0,0 +1,225 @@
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+from contextlib import contextmanager
+
+
+# Upper bounds of the latency histogram buckets, in milliseconds.
+BUCKETS_MS = [2 ** i for i in range(17)]
+
+
+class Histogram(object):
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+        ms = seconds * 1000
+        for i, bound in enumerate(BUCKETS_MS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def percentile(self, pct):
+        """Return the upper bound of the bucket holding the pct percentile, in seconds."""
+        rank = self.count * pct / 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return BUCKETS_MS[i] / 1000 if i < len(BUCKETS_MS) else self.max
+        return self.max
+
+    def summary(self):
+        buckets = {}
+        for i, n in enumerate(self.buckets):
+            if n:
+                label = f"<={BUCKETS_MS[i]}ms" if i < len(BUCKETS_MS) else f">{BUCKETS_MS[-1]}ms"
+                buckets[label] = n
+        return {
+            "count": self.count,
+            "sum_s": round(self.sum, 6),
+            "min_s": round(self.min, 6),
+            "max_s": round(self.max, 6),
+            "p50_s": self.percentile(50),
+            "p90_s": self.percentile(90),
+            "p99_s": self.percentile(99),
+            "buckets": buckets,
+        }
+
+
+class Gauge(object):
+    """A level (e.g. requests in flight) with its time-weighted average."""
+
+    def __init__(self, now):
+        self.value = 0
+        self.max = 0
+        self._area = 0.0
+        self._since = now
+        self._start = now
+
+    def add(self, delta, now):
+        self._area += self.value * (now - self._since)
+        self._since = now
+        self.value += delta
+        self.max = max(self.max, self.value)
+
+    def summary(self, now):
+        area = self._area + self.value * (now - self._since)
+        elapsed = now - self._start
+        return {"max": self.max, "avg": round(area / elapsed, 3) if elapsed else 0}
+
+
+class Metrics(object):
+    """
+    Timing and metrics of a helper run.
+
+    Disabled unless $GIT_REMOTE_BLOSSOM_METRICS or ``nostr.metrics`` names an
+    output file. The file is written at exit, as a JSON summary, or in Chrome
+    trace format (chrome://tracing, Perfetto) if its name ends in
+    ``.trace.json`` or ``nostr.metricsformat`` is ``chrome``.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._path = None
+        self._format = "json"
+        self._start = time.monotonic()
+        self._phases = {}  # {name: [count, seconds]}
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._events = []  # Chrome trace events
+        self._free_lanes = []
+        self._lanes = 0
+
+    def configure(self, path, fmt=None):
+        if not path:
+            return
+        self.enabled = True
+        self._path = path.replace("{pid}", str(os.getpid()))
+        if fmt:
+            self._format = fmt
+        elif path.endswith(".trace.json"):
+            self._format = "chrome"
+        self._start = time.monotonic()
+        atexit.register(self.write)
+
+    def _now_us(self):
+        return int((time.monotonic() - self._start) * 1e6)
+
+    def _lane(self):
+        if self._free_lanes:
+            return self._free_lanes.pop()
+        self._lanes += 1
+        return self._lanes
+
+    @contextmanager
+    def phase(self, name):
+        """Time a helper phase. Phases may repeat, durations add up."""
+        if not self.enabled:
+            yield
+            return
+        start = time.monotonic()
+        ts = self._now_us()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - start
+            entry = self._phases.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            self._events.append({"name": name, "cat": "phase", "ph": "X", "ts": ts,
+                                 "dur": int(seconds * 1e6), "pid": os.getpid(), "tid": 0})
+
+    @contextmanager
+    def span(self, name, cat, detail=None):
+        """
+        Time a single request or subprocess: it goes into the histogram of
+        name and, with its own lane, into the trace.
+        """
+        if not self.enabled:
+            yield
+            return
+        lane = self._lane()
+        self.gauge(cat, 1)
+        start = time.monotonic()
+        ts = self._now_us()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - start
+            self.gauge(cat, -1)
+            self._free_lanes.append(lane)
+            self._histograms.setdefault(name, Histogram()).observe(seconds)
+            event = {"name": name, "cat": cat, "ph": "X", "ts": ts,
+                     "dur": int(seconds * 1e6), "pid": os.getpid(), "tid": lane}
+            if detail:
+                event["args"] = {"detail": detail}
+            self._events.append(event)
+
+    @contextmanager
+    def timer(self, name):
+        """Accumulate the time of frequent, short work like hashing an object."""
+        if not self.enabled:
+            yield
+            return
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            entry = self._phases.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += time.monotonic() - start
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def gauge(self, name, delta):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if name not in self._gauges:
+            self._gauges[name] = Gauge(self._start)
+        self._gauges[name].add(delta, now)
+
+    def summary(self):
+        now = time.monotonic()
+        return {
+            "pid": os.getpid(),
+            "argv": sys.argv,
+            "wall_s": round(now - self._start, 6),
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "phases": {name: {"count": c, "total_s": round(s, 6)}
+                       for name, (c, s) in self._phases.items()},
+            "latency": {name: h.summary() for name, h in self._histograms.items()},
+            "counters": self._counters,
+            "concurrency": {name: g.summary(now) for name, g in self._gauges.items()},
+        }
+
+    def write(self):
+        if not self.enabled:
+            return
+        self.enabled = False  # Only once, and stop recording.
+        summary = self.summary()
+        if self._format == "chrome":
+            data = {"traceEvents": self._events, "displayTimeUnit": "ms", "summary": summary}
+        else:
+            data = summary
+        with open(self._path, "w") as f:
+            json.dump(data, f, indent=1)
+
+
+metrics = Metrics()
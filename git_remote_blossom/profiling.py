@@ -0,0 +1,185 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+import traceback
+
+from git_remote_blossom.constants import STALL_THRESHOLD
+from git_remote_blossom.util import stderr
+
+
+MODES = ('cpu', 'async', 'alloc')
+
+
+def _report_path(mode, ext):
+    """Return the path of a report under $GIT_DIR/blossom-profile/."""
+    directory = os.path.join(os.environ.get("GIT_DIR", "."), "blossom-profile")
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{mode}-{os.getpid()}.{ext}")
+
+
+def _call_site(frames):
+    """
+    Name the innermost frame of this package where the loop blocked, and its
+    caller in another module, e.g. "git.py:34 in command_ok <- helper.py:412
+    in _fetch". Without a frame of this package, name the innermost frame.
+    """
+    package = os.path.dirname(os.path.abspath(__file__))
+    ours = [f for f in frames if f.filename.startswith(package)
+            and f.filename != __file__ and os.sep + "cli" + os.sep not in f.filename]
+    if not ours:
+        return f"{frames[-1].filename}:{frames[-1].lineno} in {frames[-1].name}"
+    site = [ours[-1]]
+    for f in reversed(ours):
+        if f.filename != site[0].filename:
+            site.append(f)
+            break
+    return " <- ".join(f"{os.path.relpath(f.filename, package)}:{f.lineno} in {f.name}" for f in site)
+
+
+class StallMonitor(object):
+    """
+    Finds the code blocking the event loop.
+
+    A heartbeat task runs on the loop and a watchdog thread samples the stack
+    of the loop thread whenever the heartbeat is late by more than threshold
+    seconds, e.g. during a synchronous git subprocess or zlib call. Samples
+    are aggregated by the call site in this package that blocked.
+    """
+
+    def __init__(self, threshold=STALL_THRESHOLD):
+        self._threshold = threshold
+        self._interval = threshold / 5
+        self._beat = time.monotonic()
+        self._stop = threading.Event()
+        self._thread_id = threading.get_ident()
+        self._watchdog = None
+        self._sites = {}  # {call site: [samples, seconds, stack]}
+        self._stalls = []  # [(start, seconds, call site)]
+        self.max_tasks = 0
+
+    async def _heartbeat(self):
+        while True:
+            now = time.monotonic()
+            late = now - self._beat - self._interval
+            if late > self._threshold:
+                self._stalls.append((self._beat, late, self._last_site))
+            self._last_site = None
+            self._beat = now
+            self.max_tasks = max(self.max_tasks, len(asyncio.all_tasks()))
+            await asyncio.sleep(self._interval)
+
+    def _sample(self):
+        while not self._stop.wait(self._interval):
+            if time.monotonic() - self._beat - self._interval < self._threshold:
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            site = _call_site(stack)
+            entry = self._sites.setdefault(site, [0, 0.0, stack])
+            entry[0] += 1
+            entry[1] += self._interval
+            self._last_site = site
+
+    def start(self):
+        self._last_site = None
+        self._beat = time.monotonic()
+        asyncio.get_running_loop().slow_callback_duration = self._threshold
+        self._task = asyncio.create_task(self._heartbeat())
+        self._watchdog = threading.Thread(target=self._sample, daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        self._task.cancel()
+        self._stop.set()
+        self._watchdog.join()
+
+    def report(self, f):
+        blocked = sum(seconds for _, seconds, _ in self._stalls)
+        f.write(f"event loop stalls over {self._threshold * 1000:.0f}ms: {len(self._stalls)}, "
+                f"{blocked:.3f}s blocked in total\n")
+        f.write(f"max tasks: {self.max_tasks}\n\n")
+
+        f.write("blocking call sites (sampled every %.0fms):\n" % (self._interval * 1000))
+        sites = sorted(self._sites.items(), key=lambda item: -item[1][1])
+        for site, (samples, seconds, _) in sites:
+            f.write(f"  {seconds:8.3f}s {samples:6d} samples  {site}\n")
+
+        f.write("\nlongest stalls:\n")
+        for start, seconds, site in sorted(self._stalls, key=lambda s: -s[1])[:20]:
+            f.write(f"  {seconds * 1000:8.1f}ms  {site or '?'}\n")
+
+        for site, (_, seconds, stack) in sites[:10]:
+            f.write(f"\nstack of {site}:\n")
+            f.write("".join(traceback.format_list(stack)))
+
+
+async def _run_async(main, profile_path):
+    monitor = StallMonitor()
+    monitor.start()
+    try:
+        await main()
+    finally:
+        monitor.stop()
+        with open(profile_path, "w") as f:
+            monitor.report(f)
+
+
+def run(main, mode):
+    """
+    Run the coroutine function main under the profiler named by mode (see
+    MODES), and write its report under $GIT_DIR/blossom-profile/.
+    """
+    if mode not in MODES:
+        stderr(f"error: unknown profiling mode '{mode}', use one of {', '.join(MODES)}\n")
+        sys.exit(1)
+
+    if mode == 'cpu':
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            asyncio.run(main())
+        finally:
+            profiler.disable()
+            profiler.dump_stats(_report_path(mode, "prof"))
+            with open(_report_path(mode, "txt"), "w") as f:
+                stats = pstats.Stats(profiler, stream=f)
+                stats.sort_stats("cumulative").print_stats(50)
+                stats.sort_stats("tottime").print_stats(50)
+
+    elif mode == 'async':
+        # Debug mode also logs slow callbacks and never-awaited coroutines.
+        import logging
+        handler = logging.FileHandler(_report_path(mode, "log"))
+        logging.getLogger("asyncio").addHandler(handler)
+        logging.getLogger("asyncio").propagate = False
+        asyncio.run(_run_async(main, _report_path(mode, "txt")), debug=True)
+
+    elif mode == 'alloc':
+        import tracemalloc
+        tracemalloc.start(25)
+        start = tracemalloc.take_snapshot()
+        try:
+            asyncio.run(main())
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            end = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            end.dump(_report_path(mode, "snapshot"))
+            with open(_report_path(mode, "txt"), "w") as f:
+                f.write(f"current {current / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB\n")
+                f.write("\ntop allocations by line:\n")
+                for stat in end.statistics("lineno")[:30]:
+                    f.write(f"  {stat}\n")
+                f.write("\ngrowth since start:\n")
+                for stat in end.compare_to(start, "lineno")[:30]:
+                    f.write(f"  {stat}\n")
+                f.write("\ntracebacks of the largest allocations:\n")
+                for stat in end.statistics("traceback")[:5]:
+                    f.write(f"\n{stat.count} blocks, {stat.size / 1024:.1f} KiB\n")
+                    f.write("\n".join(stat.traceback.format()) + "\n")
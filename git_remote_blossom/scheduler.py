@@ -0,0 +1,62 @@
+import heapq
+from collections import deque
+
+from git_remote_blossom.metrics import metrics
+
+
+# Commits (and tags) lead to the most new objects, blobs to none.
+KIND_PRIORITY = {'commit': 0, 'tag': 0, 'tree': 1, 'blob': 2}
+
+
+class FifoScheduler(object):
+    """
+    Queue of work items, taken in the order they were added.
+
+    The queue depth is reported as the metrics gauge name.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._items = deque()
+
+    def push(self, item, kind=None, size=0):
+        self._items.append(item)
+        metrics.gauge(self._name, 1)
+
+    def pop(self):
+        metrics.gauge(self._name, -1)
+        return self._items.popleft()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class PriorityScheduler(FifoScheduler):
+    """
+    Queue of work items, taken by kind: commits and tags first, then trees,
+    then blobs. Within a kind, the largest item comes first, and items of the
+    same size in the order they were added.
+
+    On fetch this widens the frontier as fast as possible; on push the
+    largest blobs are started early instead of forming a long tail.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._items = []
+        self._seq = 0
+
+    def push(self, item, kind=None, size=0):
+        heapq.heappush(self._items, (KIND_PRIORITY.get(kind, 0), -size, self._seq, item))
+        self._seq += 1
+        metrics.gauge(self._name, 1)
+
+    def pop(self):
+        metrics.gauge(self._name, -1)
+        return heapq.heappop(self._items)[-1]
+
+
+SCHEDULERS = {
+    'fifo': FifoScheduler,
+    'priority': PriorityScheduler,
+}
@@ -53,13 +53,17 @@ setup(
 
     keywords='git remote nostr blossom',
 
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
 
     install_requires=[
         'monstr==0.1.9',
         'aiohttp>=3.9.5,<4'
     ],
 
+    extras_require={
+        'zstd': ['zstandard'],
+    },
+
     entry_points={
         'console_scripts': [
             'git-remote-blossom=git_remote_blossom.cli.helper:main',